@@ -1,64 +1,134 @@
+import time
+process_started = time.time()
+
 from basic_defs import NAS
-from cloud import RAID_on_Cloud, AWS_S3, Azure_Blob_Storage, Google_Cloud_Storage
-from hexdump import hexdump
+from cloud import RAID_on_Cloud, AWS_S3, Azure_Blob_Storage, Google_Cloud_Storage, Local_Disk_Storage
+from tiering import Hot_Tier
+from tracing import Tracer, formats as trace_formats
+from workload import Recording_NAS, replay, format_report
+from hexdump import hexdump_to
+from scrub import Scrubber
+from nas_daemon import NAS_Daemon, NAS_Client, default_socket_path
+from bulk_transfer import import_path, export_path, default_chunk_size
 
 import argparse
+import atexit
+import heapq
+import mmap
+import threading
 import traceback
 import os
 import sys
 import string
 
 class local_NAS(NAS):
-    def __init__(self):
+    """
+    NAS on the local disk (a baseline to compare RAID_on_Cloud against, and a cache tier)
+        - positional reads/writes (pread/pwrite), so threads can share an fd
+        - fds come from a free-list, lowest closed fd first, no fixed cap
+        - read_view() maps big ranges instead of copying them
+    """
+    mmap_threshold = 1024*1024 # read_view() maps ranges at least this big
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(os.getcwd(), "tmp")
         self.fds = dict()
+        self.free_fds = []
+        self.next_fd = 0
+        self.lock = threading.Lock()
+        # without pread/pwrite (python2) the seek has to stay paired with its read/write
+        self.seek_locks = dict()
 
     def open(self, filename):
-        path = os.path.join(os.getcwd(), "tmp", filename)
+        path = os.path.join(self.root, filename)
         if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another thread made it first
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
         realfd = os.open(path, os.O_RDWR | os.O_CREAT)
-        newfd = None
-        for fd in range(256):
-            if fd not in self.fds:
-                newfd = fd
-                break
-        if newfd is None:
-            raise IOError("Opened files exceed system limitation.")
-        self.fds[newfd] = realfd
+        with self.lock:
+            if self.free_fds:
+                newfd = heapq.heappop(self.free_fds)
+            else:
+                newfd = self.next_fd
+                self.next_fd += 1
+            self.fds[newfd] = realfd
+            self.seek_locks[newfd] = threading.Lock()
         return newfd
 
     def read(self, fd, len, offset):
-        if fd not in self.fds:
-            raise IOError("File descriptor %d does not exist." % fd)
-        realfd = self.fds[fd]
-        os.lseek(realfd, offset, os.SEEK_SET)
-        return os.read(realfd, len)
+        realfd = self._get_realfd(fd)
+        if hasattr(os, "pread"):
+            return os.pread(realfd, len, offset)
+        with self.seek_locks[fd]:
+            os.lseek(realfd, offset, os.SEEK_SET)
+            return os.read(realfd, len)
+
+    def read_view(self, fd, len, offset):
+        """
+        like read(), but ranges of at least mmap_threshold bytes come back as a
+        zero-copy view of a read-only mapping (memoryview, or buffer on python2)
+        """
+        realfd = self._get_realfd(fd)
+        if len < self.mmap_threshold:
+            return self.read(fd, len, offset)
+        end = min(os.fstat(realfd).st_size, offset + len)
+        if end <= offset:
+            return b""
+        # mappings have to start on an allocation boundary
+        map_start = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+        mapping = mmap.mmap(realfd, end - map_start, access=mmap.ACCESS_READ, offset=map_start)
+        try:
+            return memoryview(mapping)[offset - map_start:end - map_start]
+        except TypeError:
+            # python2's mmap only has the old buffer interface
+            return buffer(mapping, offset - map_start, end - offset)
 
     def write(self, fd, data, offset):
-        if fd not in self.fds:
-            raise IOError("File descriptor %d does not exist." % fd)
-        realfd = self.fds[fd]
-        os.lseek(realfd, offset, os.SEEK_SET)
-        os.write(realfd, data.decode('utf-8'))
+        realfd = self._get_realfd(fd)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        view = memoryview(data)
+        written = 0
+        if hasattr(os, "pwrite"):
+            while written < len(data):
+                written += os.pwrite(realfd, view[written:], offset + written)
+            return
+        with self.seek_locks[fd]:
+            os.lseek(realfd, offset, os.SEEK_SET)
+            while written < len(data):
+                written += os.write(realfd, view[written:].tobytes())
 
     def close(self, fd):
-        if fd not in self.fds:
-            raise IOError("File descriptor %d does not exist." % fd)
-        os.close(self.fds[fd])
-        del self.fds[fd]
+        with self.lock:
+            realfd = self._get_realfd(fd)
+            del self.fds[fd]
+            del self.seek_locks[fd]
+            heapq.heappush(self.free_fds, fd)
+        os.close(realfd)
         return
 
     def delete(self, filename):
-        path = os.path.join(os.getcwd(), "tmp", filename)
+        path = os.path.join(self.root, filename)
         os.unlink(path)
         path = os.path.dirname(path)
-        while not os.listdir(path):
+        # clean up the folders that are now empty (but never the root)
+        while os.path.abspath(path) != os.path.abspath(self.root) and not os.listdir(path):
             os.rmdir(path)
             path = os.path.dirname(path)
 
     def get_storage_sizes(self):
         return 0
 
+    def _get_realfd(self, fd):
+        realfd = self.fds.get(fd, None)
+        if realfd is None:
+            raise IOError("File descriptor %d does not exist." % fd)
+        return realfd
+
 def usage():
     print("***********************************************")
     print("**     Welcome to the RAID-on-Cloud NAS!     **")
@@ -73,18 +143,96 @@ def usage():
     print("**       (input from the next line)          **")
     print("**     c  / close  <fd>                      **")
     print("**     d  / delete <filename>                **")
+    print("**     import <local_path> <nas_name>        **")
+    print("**     export <nas_name> <local_path>        **")
+    print("**     snapshot <filename> [<name>]          **")
+    print("**     clone  <src> <dst>                    **")
+    print("**     stats                                 **")
     print("**     q  / quit                             **")
     print("***********************************************")
 
+# seconds from launch until the NAS is ready for its first command
+startup_target = 0.5
+
+def page_through_hexdump(data, interactive, rows_per_page=64):
+    page_size = 16 * rows_per_page
+    if not interactive or not sys.stdout.isatty() or len(data) <= page_size:
+        hexdump_to(sys.stdout, data)
+        return
+    for offset in range(0, len(data), page_size):
+        hexdump_to(sys.stdout, data, offset=offset, length=page_size)
+        if offset + page_size < len(data) and raw_input('-- more -- (<ENTER> for the next page, q to stop) ').strip() == 'q':
+            break
+
+def show_progress(message):
+    print(message)
+
 def main():
     cmd_parser = argparse.ArgumentParser(description="RAID-on-Cloud NAS CLI program.")
     cmd_parser.add_argument('--local', '-l', action='store_true', help="Running NAS in local mode (without cloud backends)") 
+    cmd_parser.add_argument('--daemon', '-D', metavar='SOCKET', nargs='?', const=default_socket_path, help="Host the NAS for other processes on a unix socket (default: %s)" % default_socket_path)
+    cmd_parser.add_argument('--connect', '-C', metavar='SOCKET', nargs='?', const=default_socket_path, help="Use the NAS hosted by a running --daemon instead of starting one")
+    cmd_parser.add_argument('--batch', '-b', metavar='FILE', help="Run the commands in FILE (- for stdin) instead of prompting. Writes take their content from the rest of the line, the exit status is non-zero if any command failed")
+    cmd_parser.add_argument('--parallel-files', type=int, default=4, help="Files transferred at once by import/export (default: 4)")
+    cmd_parser.add_argument('--parallel-blocks', type=int, default=8, help="Chunks of each file transferred at once by import/export (default: 8)")
+    cmd_parser.add_argument('--chunk-size', type=int, default=default_chunk_size, help="Bytes per import/export chunk, a multiple of 4096 (default: %d)" % default_chunk_size)
+    cmd_parser.add_argument('--startup-time', action='store_true', help="Print how long the NAS took to become ready and exit (non-zero if it's over %.1fs)" % startup_target)
+    cmd_parser.add_argument('--journal', '-j', metavar='PATH', help="Acknowledge writes once they're in this local journal and upload them in the background")
+    cmd_parser.add_argument('--write-consistency', choices=('all', 'quorum'), default='all', help="all: writes return once every replica has them, quorum: once one replica has them and the rest are logged to --replication-log (default: all)")
+    cmd_parser.add_argument('--replication-log', metavar='PATH', help="Local log of replicas that quorum writes still have to catch up (needed for --write-consistency quorum)")
+    cmd_parser.add_argument('--scrub', action='store_true', help="Run the background scrubber that repairs lost or stale replicas")
+    cmd_parser.add_argument('--scrub-rps', type=float, default=10, help="Scrubber budget in backend requests per second (default: 10)")
+    cmd_parser.add_argument('--scrub-bandwidth', type=int, default=1024*1024, help="Scrubber budget in bytes per second (default: 1MiB)")
+    cmd_parser.add_argument('--hot-tier', metavar='DIR', help="Keep frequently read blocks in this local directory in front of the clouds")
+    cmd_parser.add_argument('--hot-tier-size', type=int, default=256, help="Capacity of the hot tier in MiB (default: 256)")
+    cmd_parser.add_argument('--snapshots', metavar='DIR', help="Keep snapshot/clone metadata in this local directory (enables snapshot and clone)")
+    cmd_parser.add_argument('--trace', metavar='FILE', help="Record tracing spans of every NAS op, block and backend call, written to FILE on exit")
+    cmd_parser.add_argument('--trace-format', choices=trace_formats, default='chrome', help="chrome (trace-event json) or collapsed (stacks for flame graphs) (default: chrome)")
+    cmd_parser.add_argument('--trace-sample', type=float, default=1.0, help="Fraction of ops to trace (default: 1.0)")
+    cmd_parser.add_argument('--record', metavar='FILE', help="Record every open/read/write/close/delete to a workload trace in FILE")
+    cmd_parser.add_argument('--record-payload', action='store_true', help="Include the written data in the --record trace")
+    cmd_parser.add_argument('--replay', metavar='FILE', help="Replay a workload trace against the NAS, print its latencies and exit")
+    cmd_parser.add_argument('--replay-speed', type=float, default=1.0, help="Replay speed, 1.0 keeps the recorded timing, 0 is as fast as possible (default: 1.0)")
     args = cmd_parser.parse_args()
+    options = args
 
-    if args.local:
+    if args.connect:
+        nas = NAS_Client(args.connect)
+    elif args.local:
         nas = local_NAS()
     else:
-        nas = RAID_on_Cloud()
+        hot_tier = None
+        if args.hot_tier:
+            hot_tier = Hot_Tier(Local_Disk_Storage(args.hot_tier), capacity_bytes=args.hot_tier_size*1024*1024)
+        tracer = None
+        if args.trace:
+            tracer = Tracer(sample_rate=args.trace_sample)
+            atexit.register(tracer.export, args.trace, args.trace_format)
+        if args.write_consistency == 'quorum' and not args.replication_log:
+            cmd_parser.error("--write-consistency quorum needs --replication-log PATH")
+        nas = RAID_on_Cloud(journal_path=args.journal, hot_tier=hot_tier, snapshot_path=args.snapshots, tracer=tracer, write_consistency=args.write_consistency, replication_path=args.replication_log)
+        if args.scrub:
+            Scrubber(nas, requests_per_second=args.scrub_rps, bytes_per_second=args.scrub_bandwidth).start()
+
+    if args.replay:
+        print(format_report(replay(nas, args.replay, speed=args.replay_speed)))
+        if hasattr(nas, 'flush'):
+            nas.flush()
+        return
+
+    if args.record:
+        nas = Recording_NAS(nas, args.record, record_payload=args.record_payload)
+        atexit.register(nas.stop)
+
+    if args.startup_time:
+        startup_time = time.time() - process_started
+        print("Started in %.3fs (target: %.1fs)" % (startup_time, startup_target))
+        sys.exit(0 if startup_time <= startup_target else 1)
+
+    if args.daemon:
+        print("Serving NAS on %s" % args.daemon)
+        NAS_Daemon(nas, args.daemon).serve_forever()
+        return
 
     cli_parser = argparse.ArgumentParser()
     cli_parser.add_argument('cmd', choices=[
@@ -95,12 +243,27 @@ def main():
         'writeb',  'wb', 
         'close',   'c', 
         'delete',  'd', 
+        'import',
+        'export',
+        'snapshot',
+        'clone',
+        'stats',
         'quit',    'q'])
     cli_parser.add_argument('rest', nargs=argparse.REMAINDER)
 
-    usage()
+    if options.batch:
+        batch_file = sys.stdin if options.batch == '-' else open(options.batch)
+        # blank lines and "# comments" are skipped
+        commands = ( line.rstrip('\r\n') for line in batch_file if line.strip() and not line.strip().startswith('#') )
+    else:
+        usage()
+    failed_commands = 0
     while True:
-        astr = raw_input('NAS> ')
+        if options.batch:
+            astr = next(commands, 'quit')
+            print('NAS> ' + astr)
+        else:
+            astr = raw_input('NAS> ')
         # print astr
         try:
             args = cli_parser.parse_args(astr.split())
@@ -130,11 +293,16 @@ def main():
                         continue
                     sys.stdout.write(data + '<eof>\n')
                 else:
-                    sys.stdout.write(hexdump(data))
+                    page_through_hexdump(data, interactive=not options.batch)
                 continue
 
             if args.cmd == 'write' or args.cmd == 'w' or args.cmd == 'writeb' or args.cmd == 'wb':
-                if len(args.rest) != 2:
+                if options.batch:
+                    # the content is whatever follows the offset, spaces included
+                    args.rest = astr.split(None, 3)[1:]
+                    if len(args.rest) == 2:
+                        args.rest.append('')
+                if len(args.rest) != (3 if options.batch else 2):
                     raise SystemExit
                 try:
                     fd = int(args.rest[0])
@@ -142,6 +310,14 @@ def main():
                 except ValueError:
                     raise SystemExit
  
+                if options.batch:
+                    if args.cmd == 'write' or args.cmd == 'w':
+                        data = args.rest[2]
+                    else:
+                        data = "".join(d.decode('hex') for d in args.rest[2].split())
+                    nas.write(fd, data, offset)
+                    continue
+
                 print("Enter the content to write (To break, type <ENTER> and then <Control-D>):")
                 if args.cmd == 'write' or args.cmd == 'w':
                     data = sys.stdin.read().encode('utf-8')
@@ -174,26 +350,77 @@ def main():
                 print("File %s deleted." % args.rest[0])
                 continue
 
+            if args.cmd == 'import' or args.cmd == 'export':
+                if len(args.rest) != 2:
+                    raise SystemExit
+                transfer = import_path if args.cmd == 'import' else export_path
+                transfer(nas, args.rest[0], args.rest[1],
+                    parallel_files=options.parallel_files,
+                    parallel_blocks=options.parallel_blocks,
+                    chunk_size=options.chunk_size,
+                    progress=show_progress,
+                )
+                continue
+
+            if args.cmd == 'snapshot':
+                if len(args.rest) not in (1, 2):
+                    raise SystemExit
+                snapshot_name = nas.snapshot(*args.rest)
+                print("Snapshot of %s saved as %s." % (args.rest[0], snapshot_name))
+                continue
+
+            if args.cmd == 'clone':
+                if len(args.rest) != 2:
+                    raise SystemExit
+                nas.clone(args.rest[0], args.rest[1])
+                print("Cloned %s to %s." % (args.rest[0], args.rest[1]))
+                continue
+
+            if args.cmd == 'stats':
+                hot_tier = getattr(nas, 'hot_tier', None)
+                if not hot_tier:
+                    print("No hot tier (start with --hot-tier DIR).")
+                    continue
+                stats = hot_tier.stats()
+                print("Hot tier: %d hits, %d misses (%.1f%% hit ratio)" % (stats["hits"], stats["misses"], 100 * stats["hit_ratio"]))
+                print("  served %d bytes from local disk, %d bytes from the clouds" % (stats["local_bytes"], stats["cloud_bytes"]))
+                print("  %d blocks, %d of %d bytes used, %d admitted, %d demoted" % (stats["resident_blocks"], stats["used_bytes"], stats["capacity_bytes"], stats["admitted"], stats["demoted"]))
+                continue
+
             if args.cmd == 'quit' or args.cmd == 'q':
+                if hasattr(nas, 'flush'):
+                    print("Waiting for journaled writes and replicas to upload...")
+                    nas.flush()
                 print("Goodbye!!!")
                 break
 
         except NotImplementedError as e:
             print("Function not implemented.")
-            usage()
+            failed_commands += 1
+            if not options.batch:
+                usage()
             continue
 
         except SystemExit:
             # trap argparse error message
             print("Error.")
-            usage()
+            failed_commands += 1
+            if not options.batch:
+                usage()
             continue
 
         except Exception, e:
             traceback.print_exc()
-            usage()
+            failed_commands += 1
+            if not options.batch:
+                usage()
             continue
 
+    # a batch keeps going after a failed command (like a shell script), but the exit status says so
+    if options.batch and failed_commands:
+        print("%d command(s) failed." % failed_commands)
+        sys.exit(1)
+
 
 if __name__ == "__main__":
         main()
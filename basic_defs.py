@@ -4,9 +4,34 @@ class cloud_storage:
     def list_blocks(self):
         raise NotImplementedError
 
+    def iter_blocks(self, prefix=None, page_size=1000):
+        """
+        yields block ids (like list_blocks) a page at a time, only the ones starting with prefix
+        backends should override this to page/filter on the server
+        """
+        for each in self.list_blocks():
+            if prefix is None or str(each).startswith(prefix):
+                yield each
+
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        """
+        yields (block id, size in bytes)
+        """
+        for each in self.iter_blocks(prefix=prefix, page_size=page_size):
+            block = self.read_block(each)
+            yield each, (0 if block is None else len(block))
+
     def read_block(self, offset):
         raise NotImplementedError
 
+    def read_range(self, offset, start, end):
+        """
+        bytes [start, end) of a block (shorter if the block is), None if the block doesn't exist
+        backends should override this to only transfer those bytes
+        """
+        block = self.read_block(offset)
+        return None if block is None else block[start:end]
+
     def write_block(self, block, offset):
         raise NotImplementedError
 
@@ -23,12 +48,25 @@ class NAS:
     def write(self, fd, data, offset):
         raise NotImplementedError
 
+    # engines that encode text override these, for the rest bytes already go through read/write untouched
+    def read_bytes(self, fd, len, offset):
+        return self.read(fd, len, offset)
+
+    def write_bytes(self, fd, data, offset):
+        return self.write(fd, data, offset)
+
     def close(self, fd):
         raise NotImplementedError
 
     def delete(self, filename):
         raise NotImplementedError
 
+    def snapshot(self, filename, snapshot_name=None):
+        raise NotImplementedError
+
+    def clone(self, source, destination):
+        raise NotImplementedError
+
     def get_storage_sizes(self):
         return [len(b.list_blocks()) for b in self.backends]
 
@@ -0,0 +1,240 @@
+import json
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from file_system import FS
+
+# chunks are whole blocks, so two chunks in flight never read-modify-write the same block
+default_chunk_size = 16 * 4096
+
+#
+# import/export of whole files and directory trees
+#
+#     every import also writes "<nas_name>.manifest" (json of relative path => size),
+#     which is how export knows what's in a tree and where each file ends
+#     (the json is preceded by its length, since overwriting a longer manifest leaves its tail behind)
+#
+manifest_header_size = 16
+
+def import_path(nas, local_path, nas_name, parallel_files=4, parallel_blocks=8, chunk_size=default_chunk_size, progress=None):
+    """
+    :returns (number of files, number of bytes)
+    """
+    if chunk_size % 4096 != 0:
+        raise ValueError("chunk_size has to be a whole number of blocks (4096 bytes), got %d" % chunk_size)
+    if os.path.isdir(local_path):
+        files = []
+        for folder, _, file_names in os.walk(local_path):
+            for each in sorted(file_names):
+                relative_path = os.path.relpath(os.path.join(folder, each), local_path)
+                files.append((os.path.join(local_path, relative_path), nas_name + "/" + relative_path.replace(os.sep, "/"), relative_path.replace(os.sep, "/")))
+    else:
+        files = [ (local_path, nas_name, "") ]
+
+    manifest = {}
+    transfer = _Transfer("import", progress)
+    def import_one(each_file):
+        source, destination, relative_path = each_file
+        manifest[relative_path] = _import_file(nas, source, destination, parallel_blocks, chunk_size)
+        transfer.file_done(destination, manifest[relative_path])
+    _run_parallel(import_one, files, parallel_files)
+    manifest_data = json.dumps(manifest, sort_keys=True)
+    _write_whole(nas, nas_name + ".manifest", ("%0*d" % (manifest_header_size, len(manifest_data))) + manifest_data)
+    return transfer.done(len(files))
+
+def export_path(nas, nas_name, local_path, parallel_files=4, parallel_blocks=8, chunk_size=default_chunk_size, progress=None):
+    """
+    :returns (number of files, number of bytes)
+    """
+    manifest = _read_manifest(nas, nas_name + ".manifest") or { "": None }
+    files = []
+    for relative_path, size in sorted(manifest.items()):
+        if relative_path == "":
+            files.append((nas_name, local_path, size))
+        else:
+            files.append((nas_name + "/" + relative_path, os.path.join(local_path, *relative_path.split("/")), size))
+
+    transfer = _Transfer("export", progress)
+    def export_one(each_file):
+        source, destination, size = each_file
+        transfer.file_done(destination, _export_file(nas, source, destination, size, parallel_blocks, chunk_size))
+    _run_parallel(export_one, files, parallel_files)
+    return transfer.done(len(files))
+
+
+class _Transfer(object):
+    def __init__(self, name, progress):
+        self.name = name
+        self.progress = progress
+        self.started = time.time()
+        self.number_of_bytes = 0
+        self.lock = threading.Lock()
+
+    def file_done(self, file_name, number_of_bytes):
+        with self.lock:
+            self.number_of_bytes += number_of_bytes
+            if self.progress:
+                self.progress("%sed %s (%d bytes), %s" % (self.name, file_name, number_of_bytes, self._throughput()))
+
+    def done(self, number_of_files):
+        if self.progress:
+            self.progress("%sed %d file(s), %s" % (self.name, number_of_files, self._throughput()))
+        return number_of_files, self.number_of_bytes
+
+    def _throughput(self):
+        duration = max(time.time() - self.started, 1e-9)
+        return "%d bytes in %.2fs (%.2f MiB/s)" % (self.number_of_bytes, duration, self.number_of_bytes / duration / (1024*1024))
+
+
+def _run_parallel(function, items, parallelism):
+    """
+    calls function(item) for every item on `parallelism` threads, re-raises the first error
+    """
+    work = queue.Queue()
+    for each in items:
+        work.put(each)
+    errors = []
+    def worker():
+        while not errors:
+            try:
+                item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                function(item)
+            except Exception as error:
+                errors.append(error)
+    threads = [ threading.Thread(target=worker) for _ in range(max(1, min(parallelism, len(items)))) ]
+    for each in threads:
+        each.start()
+    for each in threads:
+        each.join()
+    if errors:
+        raise errors[0]
+
+def _import_file(nas, source, destination, parallel_blocks, chunk_size):
+    # checked before the open, which would leave an empty file behind
+    if not os.path.isfile(source):
+        raise IOError("No such file: '%s'" % source)
+    fd = nas.open(destination)
+    # bounded, so a big file is streamed instead of read into memory up front
+    chunks = queue.Queue(maxsize=parallel_blocks * 2)
+    errors = []
+    def uploader():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            offset, data = chunk
+            try:
+                # file contents are bytes, not text (RAID_on_Cloud.write would try to utf-8 encode them)
+                nas.write_bytes(fd, data, offset)
+            except Exception as error:
+                errors.append(error)
+    threads = [ threading.Thread(target=uploader) for _ in range(max(1, parallel_blocks)) ]
+    for each in threads:
+        each.start()
+    offset = 0
+    try:
+        for data in FS.read_chunks(source, chunk_size=chunk_size):
+            if errors:
+                break
+            chunks.put((offset, data))
+            offset += len(data)
+    finally:
+        for _ in threads:
+            chunks.put(None)
+        for each in threads:
+            each.join()
+        nas.close(fd)
+    if errors:
+        raise errors[0]
+    return offset
+
+def _export_file(nas, source, destination, size, parallel_blocks, chunk_size):
+    if os.path.dirname(destination):
+        FS.makedirs(os.path.dirname(destination))
+    fd = nas.open(source)
+    try:
+        with open(destination, "wb") as the_file:
+            if size is None:
+                data = _read_until_end(nas, fd, chunk_size)
+                the_file.write(data)
+                return len(data)
+            # keep parallel_blocks reads in flight, write them out in order
+            offsets = list(range(0, size, chunk_size))
+            results = {}
+            def fetch(offset):
+                results[offset] = _read_exactly(nas, fd, source, min(chunk_size, size - offset), offset)
+            for window_start in range(0, len(offsets), max(1, parallel_blocks)):
+                window = offsets[window_start:window_start + max(1, parallel_blocks)]
+                _run_parallel(fetch, window, parallel_blocks)
+                for offset in window:
+                    the_file.write(results.pop(offset))
+            return size
+    finally:
+        nas.close(fd)
+
+def _read_exactly(nas, fd, source, how_many_bytes, offset):
+    # RAID_on_Cloud.read comes back empty when any block can't be read, rather than raising
+    data = _as_bytes(nas.read_bytes(fd, how_many_bytes, offset))
+    if len(data) != how_many_bytes:
+        raise IOError("Couldn't read %s: got %d of %d bytes at offset %d" % (source, len(data), how_many_bytes, offset))
+    return data
+
+def _read_until_end(nas, fd, chunk_size):
+    # reads that run past the end of a RAID_on_Cloud file come back empty,
+    # so the last chunk is re-read one block at a time to find the tail
+    block_size = 4096
+    output = []
+    offset = 0
+    while True:
+        data = _as_bytes(nas.read_bytes(fd, chunk_size, offset))
+        if len(data) == chunk_size:
+            output.append(data)
+            offset += chunk_size
+            continue
+        if data:
+            output.append(data)
+            offset += len(data)
+            break
+        while True:
+            data = _as_bytes(nas.read_bytes(fd, block_size, offset))
+            output.append(data)
+            offset += len(data)
+            if len(data) < block_size:
+                break
+        break
+    # a lost block reads the same as the end of the file, so make sure nothing comes after it
+    # (in the rest of the chunk that came back short, and the first block of the next one)
+    chunk_end = (offset // chunk_size + 1) * chunk_size
+    for next_block in range((offset // block_size + 1) * block_size, chunk_end + block_size, block_size):
+        if _as_bytes(nas.read_bytes(fd, block_size, next_block)):
+            raise IOError("Couldn't read past offset %d, but there's data at offset %d" % (offset, next_block))
+    return b"".join(output)
+
+def _read_manifest(nas, nas_name):
+    fd = nas.open(nas_name)
+    try:
+        header = _as_bytes(nas.read(fd, manifest_header_size, 0))
+        if len(header) < manifest_header_size:
+            return None
+        return json.loads(_as_bytes(nas.read(fd, int(header), manifest_header_size)).decode("utf-8"))
+    finally:
+        nas.close(fd)
+
+def _write_whole(nas, nas_name, data):
+    fd = nas.open(nas_name)
+    try:
+        nas.write(fd, data, 0)
+    finally:
+        nas.close(fd)
+
+def _as_bytes(data):
+    # RAID_on_Cloud hands back text, local_NAS hands back bytes
+    return data if isinstance(data, bytes) else data.encode("utf-8")
@@ -7,26 +7,52 @@ import os
 import random
 import traceback
 
-from botocore.exceptions import ClientError
-import botocore
 
 logger = logging.getLogger(__name__)
 
 from basic_defs import cloud_storage, NAS
 from file_system import FS
+from resilience import Retry_Policy, Retrying_Backend, Single_Flight
+from placement import Placement
+from tracing import null_tracer, Traced_Backend
 
 import os
 import sys
 from array import array
 import hashlib
-import boto3
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 hash_it = lambda value: hashlib.sha256(str(value).encode()).hexdigest()
 length = len
 
+_settings_cache = {}
+def _read_settings(file_name):
+    """
+    credential files are parsed once per process, no matter how many times backends get built
+    """
+    if file_name not in _settings_cache:
+        _settings_cache[file_name] = FS.json_read(os.path.join("./settings/passwords.dont-sync", file_name))
+    return _settings_cache[file_name]
+
+def _block_id(key):
+    # blocks written with numeric offsets come back as ints, NAS blocks are uuid strings
+    try:
+        return int(key)
+    except Exception as error:
+        return str(key)
+
 class AWS_S3(cloud_storage):
     def __init__(self):
-        aws_data = FS.json_read("./settings/passwords.dont-sync/aws.json")
+        # the SDKs are imported here instead of at the top so that only the backends in use pay for them
+        import boto3
+        from botocore.exceptions import ClientError
+        self.ClientError = ClientError
+        aws_data = _read_settings("aws.json")
         self.access_key_id     = aws_data["access_key_id"]
         self.access_secret_key = aws_data["access_secret_key"]
         self.bucket_name       = aws_data["bucket_name"]
@@ -46,20 +72,40 @@ class AWS_S3(cloud_storage):
         return self.s3.Object(self.bucket_name, *args, **kwargs)
         
     def list_blocks(self):
-        output = []
-        for each in self._list_objects():
-            try:
-                output.append(int(each.key))
-            except Exception as error:
-                output.append(str(each.key))
-        return output
+        return list(self.iter_blocks())
+    
+    def iter_blocks(self, prefix=None, page_size=1000):
+        for key, size in self.iter_block_sizes(prefix=prefix, page_size=page_size):
+            yield key
+    
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        for page in self._list_object_pages(prefix=prefix, page_size=page_size):
+            for each in page:
+                yield _block_id(each.key), each.size
 
     def read_block(self, offset):
         key = str(offset)
         try:
             return bytearray(self._get_object(key=key))
-        except botocore.exceptions.ClientError as e:
-            return None
+        except self.ClientError as e:
+            # only a missing block is None, anything else is for the caller to retry/handle
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                return None
+            raise
+
+    def read_range(self, offset, start, end):
+        key = str(offset)
+        try:
+            # (http ranges are inclusive)
+            return bytearray(self.bucket.Object(key).get(Range="bytes=%d-%d" % (start, end - 1))['Body'].read())
+        except self.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("NoSuchKey", "404", "NotFound"):
+                return None
+            # the block ends before start
+            if code == "InvalidRange":
+                return bytearray()
+            raise
 
     def write_block(self, block, offset):
         data = str(block)
@@ -109,7 +155,7 @@ class AWS_S3(cloud_storage):
             obj.put(Body=put_data)
             obj.wait_until_exists()
             # logger.info("Put object '%s' to bucket '%s'.", key, bucket.name)
-        except ClientError:
+        except self.ClientError:
             # logger.exception("Couldn't put object '%s' to bucket '%s'.", key, bucket.name)
             raise
         finally:
@@ -131,35 +177,22 @@ class AWS_S3(cloud_storage):
         try:
             body = bucket.Object(key).get()['Body'].read()
             # logger.info("Got object '%s' from bucket '%s'.", key, bucket.name)
-        except ClientError:
+        except self.ClientError:
             # logger.exception(("Couldn't get object '%s' from bucket '%s'.", key, bucket.name))
             raise
         else:
             return body
 
 
-    def _list_objects(self, prefix=None):
+    def _list_object_pages(self, prefix=None, page_size=1000):
         """
-        Lists the objects in a bucket, optionally filtered by a prefix.
-
-        Usage is shown in usage_demo at the end of this module.
-
-        :param bucket: The bucket to query.
-        :param prefix: When specified, only objects that start with this prefix are listed.
-        :return: The list of objects.
+        Lists the objects in the bucket (optionally only the ones starting with prefix),
+        one page (one ListObjects request) at a time.
         """
         bucket = self.bucket
-        try:
-            if not prefix:
-                objects = list(bucket.objects.all())
-            else:
-                objects = list(bucket.objects.filter(Prefix=prefix))
-            # logger.info("Got objects %s from bucket '%s'", [o.key for o in objects], bucket.name)
-        except ClientError:
-            # logger.exception("Couldn't get objects for bucket '%s'.", bucket.name)
-            raise
-        else:
-            return objects
+        objects = bucket.objects.filter(Prefix=prefix) if prefix else bucket.objects.all()
+        for page in objects.page_size(page_size).pages():
+            yield page
 
     def _delete_object(self, key):
         """
@@ -176,7 +209,7 @@ class AWS_S3(cloud_storage):
             obj.delete()
             obj.wait_until_not_exists()
             # logger.info("Deleted object '%s' from bucket '%s'.", key, bucket.name)
-        except ClientError:
+        except self.ClientError:
             # logger.exception("Couldn't delete object '%s' from bucket '%s'.", key, bucket.name)
             raise
 
@@ -211,7 +244,7 @@ class AWS_S3(cloud_storage):
                 #     bucket.name
                 # )
                 pass
-        except ClientError:
+        except self.ClientError:
             # logger.exception()
             raise
         else:
@@ -220,7 +253,7 @@ class AWS_S3(cloud_storage):
 
 class Azure_Blob_Storage(cloud_storage):
     def __init__(self):
-        auth_info = FS.json_read("./settings/passwords.dont-sync/azure.json")
+        auth_info = _read_settings("azure.json")
         self.key            = auth_info["key"]
         self.conn_str       = auth_info["conn_str"]
         self.account_name   = auth_info["account_name"]
@@ -228,25 +261,45 @@ class Azure_Blob_Storage(cloud_storage):
         
          # Instantiate a BlobServiceClient using a connection string
         from azure.storage.blob import BlobServiceClient
+        from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+        self.NotFound = ResourceNotFoundError
+        self.HttpResponseError = HttpResponseError
         self.blob_service_client = BlobServiceClient.from_connection_string(self.conn_str)
         self.container_client = self.blob_service_client.get_container_client(container=self.container_name)
 
     def list_blocks(self):
-        output = []
-        for each in self.container_client.list_blobs():
-            try:
-                output.append(int(each.name))
-            except Exception as error:
-                output.append(str(each.name))
-        return output
+        return list(self.iter_blocks())
+    
+    def iter_blocks(self, prefix=None, page_size=1000):
+        for key, size in self.iter_block_sizes(prefix=prefix, page_size=page_size):
+            yield key
+    
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        blobs = self.container_client.list_blobs(name_starts_with=prefix, results_per_page=page_size)
+        for page in blobs.by_page():
+            for each in page:
+                yield _block_id(each.name), each.size
             
     def read_block(self, offset):
         key = str(offset)
         try:
             blob_client = self.blob_service_client.get_blob_client(self.container_name, key)
             return bytearray(blob_client.download_blob().readall())
-        except Exception as error:
+        except self.NotFound as error:
+            return None
+
+    def read_range(self, offset, start, end):
+        key = str(offset)
+        try:
+            blob_client = self.blob_service_client.get_blob_client(self.container_name, key)
+            return bytearray(blob_client.download_blob(offset=start, length=end - start).readall())
+        except self.NotFound as error:
             return None
+        except self.HttpResponseError as error:
+            # the block ends before start
+            if error.status_code == 416:
+                return bytearray()
+            raise
 
     def write_block(self, block, offset):
         data = str(block)
@@ -280,6 +333,8 @@ class Azure_Blob_Storage(cloud_storage):
 class Google_Cloud_Storage(cloud_storage):
     def __init__(self):
         from google.cloud import storage
+        from google.cloud.exceptions import NotFound
+        self.NotFound = NotFound
         # Google Cloud Storage is authenticated with a **Service Account**
         self.credential_file = "./settings/passwords.dont-sync/gcp-credential.json"
         self.bucket_name = "csce678-s21-p1-326001802"
@@ -287,21 +342,39 @@ class Google_Cloud_Storage(cloud_storage):
         self.bucket = self.client.lookup_bucket(self.bucket_name)
             
     def list_blocks(self):
-        output = []
-        for each in self.bucket.list_blobs():
-            try:
-                output.append(int(each.name))
-            except Exception as error:
-                output.append(str(each.name))
-        return output
+        return list(self.iter_blocks())
+    
+    def iter_blocks(self, prefix=None, page_size=1000):
+        for key, size in self.iter_block_sizes(prefix=prefix, page_size=page_size):
+            yield key
+    
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        blobs = self.bucket.list_blobs(prefix=prefix, page_size=page_size)
+        for page in blobs.pages:
+            for each in page:
+                yield _block_id(each.name), each.size
 
     def read_block(self, offset):
         key = str(offset)
         blob = self.bucket.blob(key)
         try:
             return bytearray(blob.download_as_string())
-        except Exception as error:
+        except self.NotFound as error:
+            return None
+
+    def read_range(self, offset, start, end):
+        key = str(offset)
+        blob = self.bucket.blob(key)
+        try:
+            # (end is inclusive)
+            return bytearray(blob.download_as_string(start=start, end=end - 1))
+        except self.NotFound as error:
             return None
+        except Exception as error:
+            # the block ends before start
+            if getattr(error, "code", None) == 416:
+                return bytearray()
+            raise
 
     def write_block(self, block, offset):
         data = str(block)
@@ -327,22 +400,212 @@ class Google_Cloud_Storage(cloud_storage):
     #    storage.blob.Blob:
     #        https://googleapis.dev/python/storage/latest/blobs.html
 
+class Local_Disk_Storage(cloud_storage):
+    """
+    Blocks as files in a local directory (one file per block, named after the block)
+    used as the hot tier in front of the clouds (see tiering.Hot_Tier)
+    """
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def list_blocks(self):
+        return list(self.iter_blocks())
+
+    def iter_blocks(self, prefix=None, page_size=1000):
+        for key, size in self.iter_block_sizes(prefix=prefix, page_size=page_size):
+            yield key
+
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        for each in os.listdir(self.root):
+            # half-written blocks from a crash
+            if each.endswith(".tmp"):
+                continue
+            if prefix is None or each.startswith(prefix):
+                try:
+                    yield _block_id(each), os.path.getsize(os.path.join(self.root, each))
+                except OSError as error:
+                    # deleted while listing
+                    pass
+
+    def read_block(self, offset):
+        try:
+            with open(self._path(offset), "rb") as the_file:
+                return bytearray(the_file.read())
+        except (IOError, OSError) as error:
+            return None
+
+    def read_range(self, offset, start, end):
+        try:
+            with open(self._path(offset), "rb") as the_file:
+                the_file.seek(start)
+                return bytearray(the_file.read(max(0, end - start)))
+        except (IOError, OSError) as error:
+            return None
+
+    def write_block(self, block, offset):
+        # written to the side and renamed, so a reader never sees half a block
+        path = self._path(offset)
+        temp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        with open(temp_path, "wb") as the_file:
+            the_file.write(str(block))
+        os.rename(temp_path, path)
+
+    def delete_block(self, offset):
+        try:
+            os.unlink(self._path(offset))
+        except OSError as error:
+            pass
+
+    def _path(self, offset):
+        return os.path.join(self.root, str(offset))
+
+class Lazy_Backend(cloud_storage):
+    """
+    Stands in for a backend, the real one is only imported/connected on first use
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.backend = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        if self.backend is None:
+            with self.lock:
+                if self.backend is None:
+                    self.backend = self.factory()
+        return self.backend
+    
+    def list_blocks(self):
+        return self.connect().list_blocks()
+    
+    def iter_blocks(self, prefix=None, page_size=1000):
+        return self.connect().iter_blocks(prefix=prefix, page_size=page_size)
+    
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        return self.connect().iter_block_sizes(prefix=prefix, page_size=page_size)
+    
+    def read_block(self, offset):
+        return self.connect().read_block(offset)
+    
+    def read_range(self, offset, start, end):
+        return self.connect().read_range(offset, start, end)
+    
+    def write_block(self, block, offset):
+        return self.connect().write_block(block, offset)
+    
+    def delete_block(self, offset):
+        return self.connect().delete_block(offset)
+    
+    def __getattr__(self, name):
+        # anything backend specific
+        return getattr(self.connect(), name)
+
+class Striped_Lock(object):
+    """
+    A fixed set of locks, every key maps to one of them
+    (so blocks can be locked individually without keeping a lock per block around)
+    each stripe also counts the writes that finished under it, see generation()
+    """
+    def __init__(self, stripes=1024):
+        self.locks = [ threading.Lock() for _ in range(stripes) ]
+        self.generations = [ 0 ] * stripes
+    
+    def for_key(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+    
+    def for_keys(self, keys):
+        """
+        the locks for several keys, each stripe once and always in the same order
+        (so they can be acquired one after the other without deadlocking)
+        """
+        return [ self.locks[stripe] for stripe in sorted(set(hash(key) % len(self.locks) for key in keys)) ]
+    
+    def generation(self, key):
+        """
+        changes whenever bump() is called for a key on the same stripe
+        """
+        return self.generations[hash(key) % len(self.generations)]
+    
+    def bump(self, key):
+        # (caller holds for_key(key))
+        self.generations[hash(key) % len(self.generations)] += 1
+
 class RAID_on_Cloud(NAS):
-    def __init__(self):
-        self.backends = [
-                AWS_S3(),
-                Azure_Blob_Storage(),
-                Google_Cloud_Storage()
+    def __init__(self, journal_path=None, backends=None, retry_policy=None, hot_tier=None, snapshot_path=None, placement=None, tracer=None, write_consistency="all", replication_path=None, layout_path=None, retired_backends=None):
+        if backends is None:
+            # nothing is imported or connected until a block actually lives on that backend
+            backends = [
+                Lazy_Backend(AWS_S3),
+                Lazy_Backend(Azure_Blob_Storage),
+                Lazy_Backend(Google_Cloud_Storage),
             ]
+            placement = placement or Placement([ "aws", "azure", "gcs" ])
+        # which backends hold each block (see placement.Placement)
+        self.placement = placement or Placement([ "backend-%d" % index for index in range(len(backends)) ])
+        # while a rebalance.Rebalancer is moving blocks: (old backends, old placement),
+        # blocks that haven't been moved yet are read from there
+        # with a layout_path it's kept in that file too, so other processes and restarts see it (see set_previous_layout)
+        # retired_backends is name => backend for the old backends that aren't in `backends` anymore
+        self.previous_layout = None
+        self.layout_path = layout_path
+        self.retired_backends = dict(retired_backends or {})
+        self._layout_stamp = None
+        # throttled/transient errors are retried with backoff before a replica counts as unavailable
+        self.retry_policy = retry_policy or Retry_Policy()
+        self.backends = [ Retrying_Backend(each, self.retry_policy) for each in backends ]
+        # spans for every op, block and backend call (see tracing.Tracer), a no-op unless a tracer is given
+        self.tracer = tracer or null_tracer
+        if self.tracer.enabled:
+            self.backends = [ Traced_Backend(each, self.tracer, name) for each, name in zip(self.backends, self.placement.backend_names) ]
+        self._reload_layout()
+        self.in_flight = Single_Flight()
         self.block_size = 4096
-        from collections import defaultdict
-        self.is_open = defaultdict(lambda: False)
+        self.key_prefix_cache_size = 4096
+        self._key_prefixes = {}
+        # open/close happen under self.lock, read-modify-write of a block under its stripe of self.block_locks
+        # (independent blocks proceed in parallel, only writers of the same block wait on each other)
+        self.lock = threading.Lock()
+        self.block_locks = Striped_Lock()
+        self.is_open = dict()
+        # block uuids that a read found missing on one of their replicas (see scrub.Scrubber)
+        self.repair_queue = queue.Queue(maxsize=10000)
+        # per-backend block count/size, kept up to date by our own writes and deletes
+        from inventory import Block_Inventory
+        self.inventory = Block_Inventory(self.backends)
+        # optional tiering.Hot_Tier, frequently read blocks are served from local disk
+        # (write-through, so the clouds still have every block)
+        self.hot_tier = hot_tier
+        # snapshots/clones share blocks through per-file layer chains (see snapshots.Layer_Map)
+        self.layers = None
+        if snapshot_path is not None:
+            from snapshots import Layer_Map
+            self.layers = Layer_Map(snapshot_path)
+        # with a journal, writes are acknowledged once they're fsync'd locally and uploaded in the background
+        # (the journal replays whatever wasn't uploaded yet before we return)
+        self.journal = None
+        if journal_path is not None:
+            from journal import Write_Behind_Journal
+            self.journal = Write_Behind_Journal(self, journal_path)
+        # "all": a block is stored once every replica has it
+        # "quorum": once one replica has it and the rest are logged to replication_path, they catch up in the background
+        # (see replication.Replication_Queue)
+        self.replication = None
+        if write_consistency == "quorum":
+            if replication_path is None:
+                raise ValueError("Quorum writes need a replication_path for their pending-replication log")
+            from replication import Replication_Queue
+            self.replication = Replication_Queue(self, replication_path)
+        elif write_consistency != "all":
+            raise ValueError("Unknown write consistency '%s', expected 'all' or 'quorum'" % write_consistency)
     
     def open(self, filename):
         # this seems too simple  but as far as I can tell it meets the requirements
         # (intentionally use builtin hash function)
         fd = hash(filename)
-        self.is_open[fd] = True
+        with self.lock:
+            self.is_open[fd] = True
         return fd
     
     
@@ -350,104 +613,481 @@ class RAID_on_Cloud(NAS):
         """
         # Reading the file descriptor up to the given number of bytes, at the given offset. Once the file is read successfully, the CLI will prints the output directly on the screen as UTF-8 strings.
         """
-        if not self.is_open[fd]:
+        if not self.is_open.get(fd, False):
             return "" # I hope this is the right behavior
         try:
-            
-            starting_point = offset
-            how_many_bytes = len
-            del len # len is a built in
-            block_ranges = self._get_block_ranges(fd, start_index=starting_point, end_index=(starting_point+how_many_bytes))
-            output = ""
-            # for each block
-            for (use_backend, block_id, local_start, local_end, is_final_block) in block_ranges:
-                # increment for next block
-                block_addition = None
-                for use_service, backend in zip(use_backend, self.backends):
-                    if use_service:
-                        block_string = backend.read_block(offset=block_id)
-                        if block_string is not None:
-                            block_string = str(block_string)
-                        # make resiliant by only working if the backend works
-                        if type(block_string) == str:
-                            block_addition = block_string[local_start:local_end]
-                            # if success, don't retreive the block from both
-                            break
-                # fail immediate / log
-                if type(block_addition) != str:
-                    raise Exception('ERROR: block: '+str((use_backend, block_id, local_start, local_end, is_final_block))+'\n              (use_backend, block_id, local_start, local_end, is_final_block)\n\nhad an issue and wasnt able to get the data from any sources')
-                output += block_addition
-                
-            # convert from fixed length into full unicode
-            return self._garbled_ascii_to_utf8(output)
+            with self.tracer.span("read", fd=fd, offset=offset, size=len):
+                ascii_output = self._read_ascii(fd, len, offset)
+                # convert from fixed length into full unicode
+                with self.tracer.span("decode"):
+                    return self._garbled_ascii_to_utf8(ascii_output)
+        except Exception as error:
+            return ""
+    
+    def read_bytes(self, fd, len, offset):
+        """
+        like read, but the stored bytes come back as they are instead of being utf-8 decoded (ex: binary files)
+        """
+        if not self.is_open.get(fd, False):
+            return ""
+        try:
+            with self.tracer.span("read", fd=fd, offset=offset, size=len):
+                return self._read_ascii(fd, len, offset)
         except Exception as error:
             return ""
     
+    def _read_ascii(self, fd, how_many_bytes, starting_point):
+        block_ranges = self._iter_block_ranges(fd, start_index=starting_point, end_index=(starting_point+how_many_bytes))
+        if self.tracer.enabled:
+            # planned up front so it shows up as its own span
+            with self.tracer.span("plan"):
+                block_ranges = list(block_ranges)
+        output = []
+        # for each block
+        for (use_backend, block_id, local_start, local_end, is_final_block) in block_ranges:
+            with self.tracer.span("block", key=block_id, start=local_start, end=local_end):
+                output.append(self._read_block_range(use_backend, block_id, local_start, local_end, is_final_block))
+        
+        with self.tracer.span("reassemble"):
+            return "".join(output)
+    
+    def _read_block_range(self, use_backend, block_id, local_start, local_end, is_final_block):
+        block_addition = None
+        patches = self.journal.patches_for(block_id) if self.journal else None
+        if patches:
+            # part of this block is still only in the journal
+            whole_block = self.journal.apply(self._read_existing_block(use_backend, block_id), patches)
+            return whole_block[local_start:local_end]
+        # a write that finished after a fetch started changes the generation, so later reads don't share that fetch
+        generation = self.block_locks.generation(block_id)
+        with self.tracer.span("fetch"):
+            if local_start > 0 or local_end < self.block_size:
+                # only part of the block is wanted, so only that part is downloaded
+                block_addition, missing_replica = self.in_flight.do((block_id, generation, local_start, local_end), lambda: self._fetch_range(use_backend, block_id, local_start, local_end))
+            else:
+                # readers of the same block share one fetch
+                block_string, missing_replica = self.in_flight.do((block_id, generation), lambda: self._fetch_block(use_backend, block_id))
+                # make resiliant by only working if the backend works
+                if type(block_string) == str:
+                    block_addition = block_string[local_start:local_end]
+        # the other replica saved us, but redundancy is gone until someone puts it back
+        if missing_replica and type(block_addition) == str:
+            self._queue_repair(block_id)
+        # fail immediate / log
+        if type(block_addition) != str:
+            raise Exception('ERROR: block: '+str((use_backend, block_id, local_start, local_end, is_final_block))+'\n              (use_backend, block_id, local_start, local_end, is_final_block)\n\nhad an issue and wasnt able to get the data from any sources')
+        return block_addition
+    
     def write(self, fd, data, offset):
         """
         Reading the string from the screen and write to the file descriptor at the given offset. The string will be read until the CLI detects a line break followed by a Control-D.
         """
-        if not self.is_open[fd]:
+        if not self.is_open.get(fd, False):
             return # I hope this is the right behavior
+        with self.tracer.span("write", fd=fd, offset=offset, size=len(data)):
+            # ensure that the data is properly encoded so we can write without issue and measure bytes without issue
+            with self.tracer.span("encode"):
+                ascii_data = self._utf8_to_garbled_ascii(data)
+            self._write_ascii(fd, ascii_data, offset)
+    
+    def write_bytes(self, fd, data, offset):
+        """
+        like write, but the bytes are stored as they are instead of being utf-8 encoded (ex: binary files)
+        """
+        if not self.is_open.get(fd, False):
+            return
+        with self.tracer.span("write", fd=fd, offset=offset, size=len(data)):
+            self._write_ascii(fd, str(data), offset)
+    
+    def _write_ascii(self, fd, ascii_data, offset):
         starting_point = offset
-        # ensure that the data is properly encoded so we can write without issue and measure bytes without issue
-        ascii_data     = self._utf8_to_garbled_ascii(data)
+        # whole-block overwrites of blocks the top layer doesn't have yet: top uuid => block number
+        # (they're only claimed once the new block is stored/journaled, see _copy_up)
+        unclaimed = dict()
+        if self.layers and self.layers.chain(fd) is not None:
+            if self.layers.is_read_only(fd):
+                raise IOError("Snapshots are read only")
+            # blocks shared with a snapshot/clone get a copy of their own before they're modified
+            with self.tracer.span("copy_up"):
+                unclaimed = self._copy_up(fd, starting_point, starting_point+len(ascii_data))
+            top = self.layers.chain(fd)[0]
+        if self.journal:
+            # the locks keep a copy-up of the same blocks from landing on top of the journaled data
+            locks = self.block_locks.for_keys(unclaimed)
+            for lock in locks:
+                lock.acquire()
+            try:
+                with self.tracer.span("journal_append"):
+                    self.journal.append(fd, ascii_data, offset)
+                for block_number in unclaimed.values():
+                    self.layers.claim(top, block_number)
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+            return
         how_many_bytes = len(ascii_data)
-        block_ranges   = self._get_block_ranges(fd, start_index=starting_point, end_index=(starting_point+how_many_bytes))
-        count = 0
+        block_ranges   = self._iter_block_ranges(fd, start_index=starting_point, end_index=(starting_point+how_many_bytes), for_write=True)
+        if self.tracer.enabled:
+            with self.tracer.span("plan"):
+                block_ranges = list(block_ranges)
         index = 0
         for (use_backend, block_uuid, local_start, local_end, is_final_block) in block_ranges:
-            count += 1
-            if len(block_ranges) == count:
-                is_final_block = True
-            
             amount_of_data = local_end - local_start
             # get the data based on the offset
             data_for_block = ascii_data[index: index + amount_of_data]
             # increment for next block
             index += amount_of_data
-            
-            # for each of backends that are pseudo-randomly selected
-            for use_service, backend in zip(use_backend, self.backends):
-                if use_service:
-                    # create a filler of 0's if no data exists
-                    base_data = str(bytearray(self.block_size))
-                    prexisting_string = backend.read_block(offset=block_uuid)
-                    if prexisting_string is None:
-                        prexisting_string = ""
-                    else:
-                        prexisting_string = str(prexisting_string)
-                    
-                    base_data = prexisting_string + base_data
-                    # the start is always filled up with some kind of data
-                    pre_data = base_data[0:local_start]
-                    # the ending data won't be preserved if this is the final block
-                    post_data = base_data[local_end:self.block_size] if not is_final_block else ""
-                    # if only writing in the middle, make sure to pad the sides
-                    data_for_block = pre_data + data_for_block + post_data
-                    # len(data_for_block) should be self.block_size for sure if its not the final block
-                    
+
+            # read-modify-write against the replica reads are served from, then store
+            # the exact same bytes on every replica so the copies can't diverge
+            with self.tracer.span("block", key=block_uuid, start=local_start, end=local_end):
+                with self.block_locks.for_key(block_uuid):
+                    with self.tracer.span("read_existing"):
+                        prexisting_string = self._read_existing_block(use_backend, block_uuid)
+                    with self.tracer.span("merge"):
+                        whole_block = self._merge_block(prexisting_string, data_for_block, local_start, local_end, is_final_block)
                     # save the whole block
-                    backend.write_block(block=data_for_block, offset=block_uuid)
-        
+                    with self.tracer.span("store"):
+                        self._store_block(use_backend, block_uuid, whole_block)
+                    if block_uuid in unclaimed:
+                        self.layers.claim(top, unclaimed[block_uuid])
     
     def close(self, fd):
-        self.is_open[fd] = False
+        with self.lock:
+            self.is_open[fd] = False
+    
+    def _copy_up(self, fd, start_index, end_index):
+        """
+        copies the blocks of [start_index, end_index) that only an older layer has to the top layer
+        blocks the write replaces entirely aren't copied, or claimed: until the new block is stored
+        reads have to keep going to the older layer (if the store fails, that's where they stay)
+        :returns { top uuid: block number } of those
+        """
+        top = self.layers.chain(fd)[0]
+        unclaimed = dict()
+        last_block = (end_index - 1) - ((end_index - 1) % self.block_size)
+        for block_index, local_start, local_end in self._get_segmentation(start_index, end_index):
+            block_number = block_index // self.block_size
+            if self.layers.has(top, block_number):
+                continue
+            top_uuid = self._get_uuid(top, block_index)
+            with self.block_locks.for_key(top_uuid):
+                # (another writer may have copied it while we waited)
+                if self.layers.has(top, block_number):
+                    continue
+                source = self.layers.resolve(fd, block_number)
+                overwrites_whole_block = local_start == 0 and (local_end == self.block_size or block_index == last_block)
+                if source != top and overwrites_whole_block:
+                    unclaimed[top_uuid] = block_number
+                    continue
+                if source != top:
+                    source_uuid = self._get_uuid(source, block_index)
+                    block = self._read_existing_block(self._which_providers(source_uuid), source_uuid)
+                    if self.journal:
+                        block = self.journal.apply(block, self.journal.patches_for(source_uuid))
+                    if block:
+                        self._store_block(self._which_providers(top_uuid), top_uuid, block)
+                self.layers.claim(top, block_number)
+        return unclaimed
+    
+    def snapshot(self, filename, snapshot_name=None):
+        """
+        read-only, point-in-time copy of the file, only metadata is written
+        :returns the name of the snapshot (it's opened and read like any other file)
+        """
+        if self.layers is None:
+            raise NotImplementedError
+        # journaled writes are re-resolved against the layer chains when they're replayed,
+        # so they have to reach the file's current top layer before the snapshot freezes it
+        self.flush()
+        if not snapshot_name:
+            snapshot_name = default_name = "%s@%s" % (filename, time.strftime("%Y%m%d-%H%M%S"))
+            # more than one snapshot in the same second
+            count = 1
+            while self.layers.chain(hash(snapshot_name)) is not None:
+                count += 1
+                snapshot_name = "%s.%d" % (default_name, count)
+        self.layers.snapshot(self.open(filename), self.open(snapshot_name), snapshot_name)
+        return snapshot_name
+    
+    def clone(self, source, destination):
+        """
+        copy-on-write copy of source (replacing destination), only blocks that either file modifies later get stored again
+        """
+        if self.layers is None:
+            raise NotImplementedError
+        if self.open(source) == self.open(destination):
+            raise IOError("Can't clone a file onto itself")
+        # (delete() flushes the journal first, which clones need for the same reason as snapshots)
+        self.delete(destination)
+        self.layers.clone(self.open(source), self.open(destination), destination)
+    
+    def _fetch_block(self, use_backend, block_uuid):
+        """
+        :returns (the block from the first replica that has it or None, whether a replica came up empty)
+        """
+        if self.hot_tier:
+            block_string = self.hot_tier.get(block_uuid)
+            if block_string is not None:
+                return str(block_string), False
+        return self._fetch_from_replicas(self._complete_replicas(use_backend, block_uuid), block_uuid)
+    
+    def _fetch_range(self, use_backend, block_uuid, local_start, local_end):
+        """
+        like _fetch_block, but only for bytes [local_start, local_end) of the block
+        """
+        if self.hot_tier:
+            block_string = self.hot_tier.get(block_uuid)
+            if block_string is None and self.hot_tier.would_admit(block_uuid):
+                # the tier only takes whole blocks
+                block_string, missing_replica = self._fetch_from_replicas(self._complete_replicas(use_backend, block_uuid), block_uuid)
+                return (None if block_string is None else block_string[local_start:local_end]), missing_replica
+            if block_string is not None:
+                return str(block_string)[local_start:local_end], False
+        use_backend = self._complete_replicas(use_backend, block_uuid)
+        missing_replica = False
+        for use_service, backend in zip(use_backend, self.backends):
+            if use_service:
+                try:
+                    part = backend.read_range(block_uuid, local_start, local_end)
+                except Exception as error:
+                    # out of retries on this replica, try the other one
+                    logger.warning("Couldn't read block '%s': %s", block_uuid, error)
+                    continue
+                if part is not None:
+                    if self.hot_tier:
+                        self.hot_tier.count_cloud_bytes(len(part))
+                    return str(part), missing_replica
+                missing_replica = True
+        for backend in self._previous_replicas(block_uuid):
+            try:
+                part = backend.read_range(block_uuid, local_start, local_end)
+            except Exception as error:
+                logger.warning("Couldn't read block '%s' from its previous replica: %s", block_uuid, error)
+                continue
+            if part is not None:
+                return str(part), False
+        return None, missing_replica
+    
+    def _fetch_from_replicas(self, use_backend, block_uuid):
+        if self.hot_tier:
+            # a write that lands while we're reading the clouds makes our copy too stale to admit
+            tier_version = self.hot_tier.version(block_uuid)
+        missing_replica = False
+        for use_service, backend in zip(use_backend, self.backends):
+            if use_service:
+                try:
+                    block_string = backend.read_block(offset=block_uuid)
+                except Exception as error:
+                    # out of retries on this replica, try the other one
+                    logger.warning("Couldn't read block '%s': %s", block_uuid, error)
+                    continue
+                if block_string is not None:
+                    # if success, don't retreive the block from both
+                    if self.hot_tier:
+                        self.hot_tier.offer(block_uuid, block_string, tier_version)
+                    return str(block_string), missing_replica
+                missing_replica = True
+        for backend in self._previous_replicas(block_uuid):
+            try:
+                block_string = backend.read_block(offset=block_uuid)
+            except Exception as error:
+                logger.warning("Couldn't read block '%s' from its previous replica: %s", block_uuid, error)
+                continue
+            if block_string is not None:
+                # not moved yet, that's the rebalancer's job rather than a repair
+                return str(block_string), False
+        return None, missing_replica
+    
+    def _read_existing_block(self, use_backend, block_uuid):
+        """
+        :returns the block from the first replica that has it, or "" if none do
+        """
+        # (the caller holds the block's lock, so the tier's copy can't be behind the clouds)
+        if self.hot_tier:
+            prexisting_string = self.hot_tier.get(block_uuid)
+            if prexisting_string is not None:
+                return str(prexisting_string)
+        use_backend = self._complete_replicas(use_backend, block_uuid)
+        error = None
+        for use_service, backend in zip(use_backend, self.backends):
+            if use_service:
+                try:
+                    prexisting_string = backend.read_block(offset=block_uuid)
+                except Exception as read_error:
+                    error = read_error
+                    continue
+                if prexisting_string is not None:
+                    return str(prexisting_string)
+        # if nothing could be read, writing zeros over the block could lose data
+        if error is not None:
+            raise error
+        for backend in self._previous_replicas(block_uuid):
+            prexisting_string = backend.read_block(offset=block_uuid)
+            if prexisting_string is not None:
+                return str(prexisting_string)
+        return ""
+    
+    def _complete_replicas(self, use_backend, block_uuid):
+        """
+        use_backend without any replicas that a quorum write left behind (they'd return an older copy)
+        """
+        if self.replication is None:
+            return use_backend
+        return self.replication.complete_replicas(use_backend, block_uuid)
+    
+    def set_previous_layout(self, old_backends, old_placement):
+        """
+        called by rebalance.Rebalancer when it starts, and with (None, None) once every block is moved
+        """
+        self.previous_layout = None if old_placement is None else (old_backends, old_placement)
+        if self.layout_path is None:
+            return
+        if old_placement is None:
+            if os.path.exists(self.layout_path):
+                os.unlink(self.layout_path)
+        else:
+            temp_path = self.layout_path + ".tmp"
+            with open(temp_path, "w") as the_file:
+                json.dump(dict(backend_names=old_placement.backend_names, replicas=old_placement.replicas), the_file)
+                the_file.flush()
+                os.fsync(the_file.fileno())
+            os.rename(temp_path, self.layout_path)
+        self._layout_stamp = self._layout_file_stamp()
+    
+    def _reload_layout(self):
+        """
+        :returns self.previous_layout, after re-reading layout_path if it changed (ex: a rebalance started by another process)
+        """
+        if self.layout_path is None:
+            return self.previous_layout
+        stamp = self._layout_file_stamp()
+        if stamp == self._layout_stamp:
+            return self.previous_layout
+        if stamp is None:
+            self.previous_layout = None
+        else:
+            with open(self.layout_path) as the_file:
+                layout = json.load(the_file)
+            backends_by_name = dict(zip(self.placement.backend_names, self.backends))
+            old_backends = []
+            for name in layout["backend_names"]:
+                if name in backends_by_name:
+                    old_backends.append(backends_by_name[name])
+                elif name in self.retired_backends:
+                    old_backends.append(Retrying_Backend(self.retired_backends[name], self.retry_policy))
+                else:
+                    raise ValueError("A rebalance is still moving blocks off of backend '%s' (see %s), it has to be in retired_backends" % (name, self.layout_path))
+            self.previous_layout = (old_backends, Placement(layout["backend_names"], layout["replicas"]))
+        self._layout_stamp = stamp
+        return self.previous_layout
+    
+    def _layout_file_stamp(self):
+        try:
+            stat = os.stat(self.layout_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+    
+    def _previous_replicas(self, block_uuid):
+        """
+        :yields the backends that held the block before the rebalance that's in progress (if there is one)
+        """
+        previous_layout = self._reload_layout()
+        if previous_layout is None:
+            return
+        old_backends, old_placement = previous_layout
+        for use_service, backend in zip(old_placement.providers(block_uuid), old_backends):
+            if use_service:
+                yield backend
+    
+    def _merge_block(self, prexisting_string, data_for_block, local_start, local_end, is_final_block):
+        # create a filler of 0's if no data exists
+        base_data = prexisting_string + str(bytearray(self.block_size))
+        # the start is always filled up with some kind of data
+        pre_data = base_data[0:local_start]
+        # the ending data won't be preserved if this is the final block
+        post_data = base_data[local_end:self.block_size] if not is_final_block else ""
+        # if only writing in the middle, make sure to pad the sides
+        # (should be self.block_size long for sure if its not the final block)
+        return pre_data + data_for_block + post_data
+    
+    def _store_block(self, use_backend, block_uuid, whole_block):
+        # for each of backends that are pseudo-randomly selected
+        try:
+            if self.replication:
+                self.replication.store(use_backend, block_uuid, whole_block)
+            else:
+                for backend_index, (use_service, backend) in enumerate(zip(use_backend, self.backends)):
+                    if use_service:
+                        backend.write_block(block=whole_block, offset=block_uuid)
+                        self.inventory.record_write(backend_index, block_uuid, len(whole_block))
+        except Exception as error:
+            # some replicas may have the new block, so the tier's copy can't be trusted either way
+            if self.hot_tier:
+                self.hot_tier.invalidate(block_uuid)
+            self.block_locks.bump(block_uuid)
+            raise
+        if self.hot_tier:
+            self.hot_tier.update(block_uuid, whole_block)
+        # last, so a read that joins a fetch of this generation also sees the tier's new copy
+        # (the caller holds the block's lock)
+        self.block_locks.bump(block_uuid)
+    
+    def get_storage_sizes(self):
+        # answered from the inventory, only the first call (or reconcile()) lists the buckets
+        return self.inventory.counts()
+    
+    def _queue_repair(self, block_uuid):
+        try:
+            self.repair_queue.put_nowait(block_uuid)
+        except queue.Full:
+            # the scrubber's periodic pass will still find it
+            pass
+    
+    def flush(self):
+        """
+        waits for any journaled writes to reach the backends (and for quorum writes to reach every replica)
+        """
+        if self.journal:
+            self.journal.flush()
+        if self.replication:
+            self.replication.flush()
     
     def delete(self, filename):
+        # otherwise the journal could re-upload blocks after we delete them
+        self.flush()
         fd = self.open(filename)
-        file_prefix = self._get_prefix(fd)
+        # layers still used by a snapshot/clone stay
+        unused_layers = self.layers.remove(fd, filename) if self.layers else [ fd ]
         while True:
-            for each_backend in self.backends:
-                uuids = each_backend.list_blocks()
-                for each_block_id in uuids:
-                    if type(each_block_id) == str:
-                        if each_block_id.startswith(file_prefix):
-                            for backend in self.backends:
-                                try:
-                                    backend.delete_block(each_block_id)
-                                except Exception as error:
-                                    pass
+            for layer in unused_layers:
+                file_prefix = self._get_prefix(layer)
+                listed_on = dict() # block id => [ (backend index, backend) ]
+                for backend_index, each_backend in self._all_backends():
+                    # only this file's blocks, filtered by the backend
+                    for each_block_id in each_backend.iter_blocks(prefix=file_prefix):
+                        if type(each_block_id) == str:
+                            listed_on.setdefault(each_block_id, []).append((backend_index, each_backend))
+                for each_block_id, replicas in listed_on.items():
+                    # every replica goes under the block's lock, otherwise a repair that runs between two of the deletes
+                    # would put the block back from the replica that's still there
+                    # (its current replicas too, a repair may have re-uploaded one since we listed)
+                    for backend_index, (use_service, backend) in enumerate(zip(self._which_providers(each_block_id), self.backends)):
+                        if use_service and (backend_index, backend) not in replicas:
+                            replicas.append((backend_index, backend))
+                    with self.block_locks.for_key(each_block_id):
+                        for backend_index, each_backend in replicas:
+                            try:
+                                each_backend.delete_block(each_block_id)
+                                if backend_index is not None:
+                                    self.inventory.record_delete(backend_index, each_block_id)
+                            except Exception as error:
+                                pass
+                        self.block_locks.bump(each_block_id)
+                # (every pass, since the check below can re-admit a block the clouds haven't dropped yet)
+                if self.hot_tier:
+                    self.hot_tier.invalidate_prefix(file_prefix)
             
             if len(self.read(fd, 1, 0)) > 0:
                 print('self.read(fd, 10, 0) = ', self.read(fd, 1, 0))
@@ -459,6 +1099,19 @@ class RAID_on_Cloud(NAS):
             else:
                 break
     
+    def _all_backends(self):
+        """
+        :yields (index, backend) for our backends, and (None, backend) for the ones only a rebalance in progress is still moving blocks off of
+        """
+        for backend_index, backend in enumerate(self.backends):
+            yield backend_index, backend
+        previous_layout = self._reload_layout()
+        if previous_layout is not None:
+            old_backends, old_placement = previous_layout
+            for name, backend in zip(old_placement.backend_names, old_backends):
+                if name not in self.placement.backend_names:
+                    yield None, backend
+    
     def _utf8_to_garbled_ascii(self, string):
         # is this very roundabout? yes
         # is it the only way I could find in python2 and be certain about? yes
@@ -483,87 +1136,75 @@ class RAID_on_Cloud(NAS):
     
     # helpers
     def _which_providers(self, hash_address):
-        which_combo = hash(hash_address) % 3
-        use_aws   = False
-        use_azure = False
-        use_gcs   = False
-        if which_combo == 0:
-            use_aws   = True
-            use_azure = True
-            # use_gcs   = False
-        elif which_combo == 1:
-            # use_aws   = False
-            use_azure = True
-            use_gcs   = True
-        else:
-            use_aws   = True
-            # use_azure = False
-            use_gcs   = True
-        return (use_aws, use_azure, use_gcs)
+        """
+        :returns a bool per backend, ex: (use_aws, use_azure, use_gcs)
+        """
+        return self.placement.providers(hash_address)
     
     def _get_prefix(self, fd):
         return str(fd)+"-"
     
+    def _get_key_prefix(self, fd):
+        """
+        :returns (prefix, sha256 state already fed with hash_it(fd))
+        both only depend on the fd, so they're computed once per fd instead of once per block
+        """
+        cached = self._key_prefixes.get(fd, None)
+        if cached is None:
+            if length(self._key_prefixes) >= self.key_prefix_cache_size:
+                self._key_prefixes.clear()
+            cached = (self._get_prefix(fd), hashlib.sha256(hash_it(fd).encode()))
+            self._key_prefixes[fd] = cached
+        return cached
+    
     def _get_uuid(self, fd, block_index):
         # I know this looks weird, but it should prevent collisions
         # just doing a hash_it(filename+str(block_index)) would cause tonz of collisions
-        hash_for_number = hash_it(block_index)
-        hash_for_file = hash_it(fd)
-        uuid_hopefully = hash_it(hash_for_file + hash_for_number)
-        prefix = str(fd)+"-"
-        return self._get_prefix(fd)+uuid_hopefully
-    
-    def _get_address_range(self, start_offset=0, end_offset=0):
-        start_block_index = 0
-        end_block_index = 0
-        
-        blocks_past = start_offset / self.block_size
-        actual_start_block_index = self.block_size * blocks_past
-        local_start = start_offset - actual_start_block_index
-        
-        blocks_till_end = end_offset / self.block_size
-        local_end = min([ self.block_size, end_offset - actual_start_block_index ])
-        
-        if local_start > local_end:
-            print('Something went wrong in _get_address_range(), end is before start\n    start_block_index='+str(start_block_index)+'\n    start_offset='+str(start_offset)+'\n    end_block_index='+str(end_block_index)+'\n    end_offset='+str(end_offset))
-            raise Exception('Something went wrong in _get_address_range(), end is before start\n    start_block_index='+str(start_block_index)+'\n    start_offset='+str(start_offset)+'\n    end_block_index='+str(end_block_index)+'\n    end_offset='+str(end_offset))
-        
-        return actual_start_block_index, local_start, local_end
-            
+        # (same digest as hash_it(hash_it(fd) + hash_it(block_index)), the fd half is just pre-fed)
+        prefix, hash_for_file = self._get_key_prefix(fd)
+        uuid_hopefully = hash_for_file.copy()
+        uuid_hopefully.update(hash_it(block_index).encode())
+        return prefix+uuid_hopefully.hexdigest()
+    
     def _get_segmentation(self, start_index, end_index):
         """
-        :returns [(block_index, local_start, local_end)]
+        :yields (block_index, local_start, local_end)
+        only the first and last block can be partial, so everything is computed arithmetically
         """
         # no blocks
-        if start_index == end_index:
-            return []
-        
-        segments = []
-        missing_number_of_bytes = end_index - start_index
-        while missing_number_of_bytes > 0:
-            block_index, local_start, local_end = self._get_address_range(start_offset=start_index, end_offset=end_index)
-            bytes_gathered = local_end - local_start
-            missing_number_of_bytes -= bytes_gathered
-            segments.append((block_index, local_start, local_end))
-            start_index = block_index + local_end
-        
-        return segments
+        if end_index <= start_index:
+            return
         
+        block_size  = self.block_size
+        first_block = start_index - (start_index % block_size)
+        last_block  = (end_index - 1) - ((end_index - 1) % block_size)
+        block_index = first_block
+        while block_index <= last_block:
+            local_start = start_index - block_index if block_index == first_block else 0
+            local_end   = end_index   - block_index if block_index == last_block  else block_size
+            yield (block_index, local_start, local_end)
+            block_index += block_size
+    
+    def _iter_block_ranges(self, fd, start_index, end_index, for_write=False):
+        """
+        :yields ((use_aws, use_azure, use_gcs), uuid, local_start, local_end, is_final_block)
+        """
+        last_block = (end_index - 1) - ((end_index - 1) % self.block_size)
+        chain = self.layers.chain(fd) if self.layers else None
+        for block_index, local_start, local_end in self._get_segmentation(start_index, end_index):
+            # snapshotted/cloned files keep each block in one of their layers,
+            # writes always go to the newest one (after _copy_up)
+            if chain is None:
+                layer = fd
+            elif for_write:
+                layer = chain[0]
+            else:
+                layer = self.layers.resolve(fd, block_index // self.block_size)
+            block_uuid = self._get_uuid(layer, block_index)
+            yield (self._which_providers(block_uuid), block_uuid, local_start, local_end, block_index == last_block)
+    
     def _get_block_ranges(self, fd, start_index, end_index):
         """
         returns [ ((use_aws, use_azure, use_gcs), uuid, local_start, local_end, is_final_block) ]
         """
-        segments = self._get_segmentation(start_index, end_index)
-        blocks = []
-        for block_index, local_start, local_end in segments:
-            block_uuid = self._get_uuid(fd, block_index)
-            (use_aws, use_azure, use_gcs) = self._which_providers(block_uuid)
-            blocks.append(((use_aws, use_azure, use_gcs), block_uuid, local_start, local_end, False))
-        
-        # set the "is_final_block" for the last one
-        if len(blocks) > 1:
-            (use_aws, use_azure, use_gcs), block_uuid, local_start, local_end, _ = blocks[-1]
-            blocks[-1] = ((use_aws, use_azure, use_gcs), block_uuid, local_start, local_end, True)
-            
-        return blocks
-    
\ No newline at end of file
+        return list(self._iter_block_ranges(fd, start_index, end_index))
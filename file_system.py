@@ -14,25 +14,43 @@ import shutil
 class FileSystem():
     @classmethod
     def size_of(self, file_path):
-        import os
         if self.is_dir(file_path):
             raise Exception('Sorry FS.size_of() currently does not work on folders')
-            
-        file = open(file_path)
-        file.seek(0, os.SEEK_END)
-        number_of_bytes = file.tell()
-        file.close()
-        return number_of_bytes
+        return os.stat(file_path).st_size
     
     @classmethod
     def write(self, data, to=None):
+        # binary data goes straight to disk instead of through str()
+        if isinstance(data, (bytearray, memoryview)) or (bytes is not str and isinstance(data, bytes)):
+            return self.write_bytes(data, to=to)
         # make sure the path exists
         self.makedirs(os.path.dirname(to))
         with open(to, 'w') as the_file:
             the_file.write(str(data))
     
+    @classmethod
+    def write_bytes(self, data, to=None, buffer_size=1024*1024):
+        """
+        data can be bytes-like or an iterable of bytes-like chunks (ex: from FS.read_chunks())
+        """
+        import io
+        # make sure the path exists
+        self.makedirs(os.path.dirname(to))
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = [ data ]
+        with io.open(to, 'wb', buffering=buffer_size) as the_file:
+            for chunk in data:
+                the_file.write(chunk)
+    
     @classmethod
     def read(self, file_path, into="string"):
+        """
+        into:
+            "string"       => the whole file as a string
+            "binary_array" => the whole file as an array('B')
+            "memoryview"   => a zero-copy read-only view of the file mapped into memory
+                              (python2's mmap only supports the old buffer interface, so there it's a buffer)
+        """
         try:
             if into == "string":
                 with open(file_path,'r') as f:
@@ -43,9 +61,33 @@ class FileSystem():
                 output = array('B')
                 with open(file_path, 'rb') as f:
                     output.fromfile(f, size)
+            elif into == "memoryview":
+                import mmap
+                with open(file_path, 'rb') as f:
+                    # empty files can't be mapped
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return memoryview(b"")
+                    # the mapping stays valid after the file is closed
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    output = memoryview(mapping)
+                except TypeError:
+                    output = buffer(mapping)
         except:
             output = None
         return output    
+    
+    @classmethod
+    def read_chunks(self, file_path, chunk_size=1024*1024):
+        """
+        yields the file as bytes, chunk_size at a time (for files that don't fit in memory)
+        """
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
         
     @classmethod
     def delete(self, file_path):
@@ -17,39 +17,36 @@
 
 """
 Hexdump implementation in Python 2.7 and 3.
+
+Whole chunks are formatted at once (binascii.hexlify for the hex columns,
+bytes.translate for the printable column), and dumps can be streamed a
+window at a time instead of being built in memory.
 """
 
 from __future__ import unicode_literals
 
+import binascii
 import sys
 
 __python3__ = sys.version_info > (3,)
 
+# rows are formatted this many bytes at a time
+_chunk_size = 64 * 1024
+
+# byte => itself if printable, '.' otherwise
+_printable = bytes(bytearray(
+    i if 32 <= i < 127 else ord('.') for i in range(256)
+))
+
 
 def ordp(c):
     """
     Helper that returns a printable binary data representation.
     """
-    output = []
-
-    if __python3__:
-        for i in c:
-            if (i < 32) or (i >= 127):
-                output.append('.')
-            else:
-                output.append(chr(i))
-    else:
-        for i in c:
-            j = ord(i)
-            if (j < 32) or (j >= 127):
-                output.append('.')
-            else:
-                output.append(i)
-
-    return ''.join(output)
-
-
-def hexdump(p):
+    return _as_bytes(c).translate(_printable).decode('ascii')
+
+
+def hexdump(p, offset=0, length=None):
     """
     Return a hexdump representation of binary data.
     Usage:
@@ -59,27 +56,54 @@ def hexdump(p):
     ... ))
     0000   00 01 43 41 46 45 43 41  46 45 00 01               ..CAFECAFE..
     """
-    output = []
-    l = len(p)
-    i = 0
-    while i < l:
-        output.append('{:04d}   '.format(i))
-        for j in range(16):
-            if (i + j) < l:
-                if __python3__:
-                    byte = p[i + j]
-                else:
-                    byte = ord(p[i + j])
-                output.append('{:02X} '.format(byte))
-            else:
-                output.append('   ')
-            if (j % 16) == 7:
-                output.append(' ')
-        output.append('  ')
-        output.append(ordp(p[i:i + 16]))
-        output.append('\n')
-        i += 16
-    return ''.join(output)
-
-
-__all__ = ['hexdump']
+    return ''.join(hexdump_lines(p, offset, length))
+
+
+def hexdump_to(stream, p, offset=0, length=None):
+    """
+    Write the hexdump of p[offset:offset+length] to stream, one chunk at a time.
+    """
+    for chunk in _hexdump_chunks(p, offset, length):
+        stream.write(chunk)
+
+
+def hexdump_lines(p, offset=0, length=None):
+    """
+    Yield the hexdump of p[offset:offset+length] line by line.
+    Addresses are positions in p, so windows can be used to page through it.
+    """
+    for chunk in _hexdump_chunks(p, offset, length):
+        for line in chunk.splitlines(True):
+            yield line
+
+
+def _hexdump_chunks(p, offset, length):
+    p = _as_bytes(p)
+    end = len(p) if length is None else min(len(p), offset + length)
+    for chunk_start in range(offset, end, _chunk_size):
+        chunk = p[chunk_start:min(end, chunk_start + _chunk_size)]
+        chunk = chunk.tobytes() if isinstance(chunk, memoryview) else bytes(chunk)
+        # interleave the hex digits with spaces: "AABB" => "AA BB "
+        spaced = bytearray(b' ' * (3 * len(chunk)))
+        hex_digits = binascii.hexlify(chunk).upper()
+        spaced[0::3] = hex_digits[0::2]
+        spaced[1::3] = hex_digits[1::2]
+        spaced = bytes(spaced).decode('ascii')
+        printable = chunk.translate(_printable).decode('ascii')
+        output = []
+        for i in range(0, len(chunk), 16):
+            row = spaced[3 * i:3 * i + 48]
+            if len(row) < 48:
+                row = row.ljust(48)
+            output.append('{:04d}   {} {}  {}\n'.format(chunk_start + i, row[:24], row[24:], printable[i:i + 16]))
+        yield ''.join(output)
+
+
+def _as_bytes(p):
+    # text is dumped as its UTF-8 encoding
+    if isinstance(p, type('')):
+        return p.encode('utf-8')
+    return p
+
+
+__all__ = ['hexdump', 'hexdump_to', 'hexdump_lines']
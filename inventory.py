@@ -0,0 +1,78 @@
+import threading
+
+class Block_Inventory(object):
+    """
+    Local index of what every backend holds: block id => size
+        - record_write/record_delete keep it current as the NAS writes and deletes
+        - counts()/sizes() are answered from memory
+        - reconcile() is the only thing that lists the buckets (done once, on first use,
+          and again whenever someone else may have changed the buckets),
+          writes/deletes recorded while a backend is being listed win over what the listing saw
+    """
+    def __init__(self, backends):
+        self.backends = backends
+        self.lock = threading.Lock()
+        self.blocks = [ dict() for _ in backends ]
+        self.total_bytes = [ 0 for _ in backends ]
+        # while a backend is being listed: block id => size, or None if it was deleted
+        self.changes = [ None for _ in backends ]
+        self.reconcile_lock = threading.Lock()
+        self.reconciled = False
+
+    def record_write(self, backend_index, block_id, size):
+        with self.lock:
+            blocks = self.blocks[backend_index]
+            self.total_bytes[backend_index] += size - blocks.get(block_id, 0)
+            blocks[block_id] = size
+            if self.changes[backend_index] is not None:
+                self.changes[backend_index][block_id] = size
+
+    def record_delete(self, backend_index, block_id):
+        with self.lock:
+            self.total_bytes[backend_index] -= self.blocks[backend_index].pop(block_id, 0)
+            if self.changes[backend_index] is not None:
+                self.changes[backend_index][block_id] = None
+
+    def counts(self):
+        """
+        :returns [ number of blocks on each backend ]
+        """
+        self._ensure_reconciled()
+        with self.lock:
+            return [ len(blocks) for blocks in self.blocks ]
+
+    def sizes(self):
+        """
+        :returns [ number of bytes on each backend ]
+        """
+        self._ensure_reconciled()
+        with self.lock:
+            return list(self.total_bytes)
+
+    def reconcile(self, page_size=1000):
+        """
+        rebuilds the index from a full (paged) listing of every backend
+        """
+        with self.reconcile_lock:
+            for backend_index, backend in enumerate(self.backends):
+                with self.lock:
+                    self.changes[backend_index] = dict()
+                try:
+                    blocks = dict(backend.iter_block_sizes(page_size=page_size))
+                    with self.lock:
+                        # the listing may or may not have seen these, they're newer either way
+                        for block_id, size in self.changes[backend_index].items():
+                            if size is None:
+                                blocks.pop(block_id, None)
+                            else:
+                                blocks[block_id] = size
+                        self.blocks[backend_index] = blocks
+                        self.total_bytes[backend_index] = sum(blocks.values())
+                finally:
+                    with self.lock:
+                        self.changes[backend_index] = None
+            self.reconciled = True
+
+    def _ensure_reconciled(self):
+        if not self.reconciled:
+            self.reconcile()
@@ -0,0 +1,212 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+class Write_Ahead_Log(object):
+    """
+    Append-only, fsync'd record log on local disk
+        - every record gets an increasing sequence number
+        - checkpoint(seq) marks everything up to seq as applied, those records are skipped on replay
+        - once everything is applied the log file is truncated back to nothing
+    a torn/corrupt tail (crash in the middle of an append) is detected by the crc and cut off
+    """
+    header = struct.Struct("!QII") # seq, payload length, crc32 of payload
+
+    def __init__(self, path):
+        self.path            = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.lock            = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.applied_seq = self._read_checkpoint()
+        self.pending     = list(self._read_records())
+        self.last_seq    = max([self.applied_seq] + [ seq for seq, _ in self.pending ])
+        self.file        = open(path, "ab")
+
+    def append(self, payload):
+        """
+        :returns the sequence number of the record, once it is durable
+        """
+        with self.lock:
+            self.last_seq += 1
+            self.file.write(self.header.pack(self.last_seq, len(payload), zlib.crc32(payload) & 0xffffffff))
+            self.file.write(payload)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            return self.last_seq
+
+    def checkpoint(self, seq):
+        with self.lock:
+            if seq <= self.applied_seq:
+                return
+            self.applied_seq = seq
+            temp_path = self.checkpoint_path + ".tmp"
+            with open(temp_path, "w") as the_file:
+                the_file.write(str(seq))
+                the_file.flush()
+                os.fsync(the_file.fileno())
+            os.rename(temp_path, self.checkpoint_path)
+            # nothing left to replay, so there's no reason to keep the log around
+            if self.applied_seq >= self.last_seq:
+                self.file.truncate(0)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as the_file:
+                return int(the_file.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _read_records(self):
+        """
+        :yields (seq, payload) for every record that hasn't been checkpointed
+        """
+        if not os.path.exists(self.path):
+            return
+        good_until = 0
+        with open(self.path, "rb") as the_file:
+            while True:
+                header = the_file.read(self.header.size)
+                if len(header) < self.header.size:
+                    break
+                seq, size, crc = self.header.unpack(header)
+                payload = the_file.read(size)
+                if len(payload) < size or (zlib.crc32(payload) & 0xffffffff) != crc:
+                    break
+                good_until = the_file.tell()
+                if seq > self.applied_seq:
+                    yield seq, payload
+        if good_until < os.path.getsize(self.path):
+            logger.warning("Dropping torn tail of journal '%s' after byte %d", self.path, good_until)
+            with open(self.path, "r+b") as the_file:
+                the_file.truncate(good_until)
+
+
+class Write_Behind_Journal(object):
+    """
+    Makes RAID_on_Cloud writes return as soon as they're fsync'd to a local log
+        - append() logs the write and records its per-block patches in memory
+        - reads merge those patches on top of whatever the clouds have, so they see journaled data right away
+        - a background uploader drains the log to the backends in batches (one read-modify-write per block per batch)
+        - on restart the un-uploaded part of the log is replayed before the engine is handed out
+    """
+    record_header = struct.Struct("!qQ") # fd, offset
+
+    def __init__(self, nas, path, batch_size=64, retry_delay=1.0):
+        self.nas         = nas
+        self.batch_size  = batch_size
+        self.retry_delay = retry_delay
+        self.log         = Write_Ahead_Log(path)
+        self.lock        = threading.Condition(threading.Lock())
+        # [ (seq, [ (use_backend, block_uuid, patch) ]) ] in log order
+        self.pending     = deque()
+        # block_uuid => [ (seq, local_start, local_end, data, is_final_block) ]
+        self.patches     = dict()
+        self._stop       = False
+        for seq, payload in self.log.pending:
+            fd, offset = self.record_header.unpack(payload[:self.record_header.size])
+            self._add(seq, fd, payload[self.record_header.size:], offset)
+        del self.log.pending
+        self._thread = threading.Thread(target=self._upload_loop, name="journal-uploader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, fd, ascii_data, offset):
+        # logged under the lock so the in-memory order always matches the log order
+        with self.lock:
+            seq = self.log.append(self.record_header.pack(fd, offset) + ascii_data)
+            self._add(seq, fd, ascii_data, offset)
+            self.lock.notify_all()
+
+    def patches_for(self, block_uuid):
+        """
+        :returns a snapshot of the not-yet-uploaded patches of a block, oldest first
+        """
+        with self.lock:
+            return list(self.patches.get(block_uuid, ()))
+
+    def apply(self, block, patches):
+        # patches are idempotent, so it doesn't matter if the uploader already
+        # put some of them into `block` between patches_for() and the cloud read
+        for seq, local_start, local_end, data, is_final_block in patches:
+            block = self.nas._merge_block(block, data, local_start, local_end, is_final_block)
+        return block
+
+    def flush(self):
+        """
+        blocks until everything journaled so far is on the backends
+        """
+        with self.lock:
+            while self.pending:
+                self.lock.wait(0.1)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self._stop = True
+            self.lock.notify_all()
+        self._thread.join()
+        self.log.close()
+
+    def _add(self, seq, fd, ascii_data, offset):
+        block_patches = []
+        index = 0
+        for (use_backend, block_uuid, local_start, local_end, is_final_block) in self.nas._iter_block_ranges(fd, offset, offset+len(ascii_data), for_write=True):
+            patch = (seq, local_start, local_end, ascii_data[index:index + local_end - local_start], is_final_block)
+            index += local_end - local_start
+            self.patches.setdefault(block_uuid, []).append(patch)
+            block_patches.append((use_backend, block_uuid, patch))
+        self.pending.append((seq, block_patches))
+
+    def _upload_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self._stop:
+                    self.lock.wait()
+                if self._stop:
+                    return
+                batch = [ self.pending[index] for index in range(min(self.batch_size, len(self.pending))) ]
+            try:
+                self._upload(batch)
+            except Exception as error:
+                logger.warning("Journal upload failed, retrying in %ss: %s", self.retry_delay, error)
+                time.sleep(self.retry_delay)
+                continue
+            last_seq = batch[-1][0]
+            # checkpoint first, so once flush() sees an empty queue the log agrees
+            self.log.checkpoint(last_seq)
+            with self.lock:
+                for _ in batch:
+                    self.pending.popleft()
+                for seq, block_patches in batch:
+                    for use_backend, block_uuid, patch in block_patches:
+                        remaining = [ each for each in self.patches.get(block_uuid, ()) if each[0] > last_seq ]
+                        if remaining:
+                            self.patches[block_uuid] = remaining
+                        else:
+                            self.patches.pop(block_uuid, None)
+                self.lock.notify_all()
+
+    def _upload(self, batch):
+        # coalesce: every block touched by the batch is read and written once
+        blocks = OrderedDict()
+        for seq, block_patches in batch:
+            for use_backend, block_uuid, patch in block_patches:
+                blocks.setdefault(block_uuid, (use_backend, []))[1].append(patch)
+        for block_uuid, (use_backend, patches) in blocks.items():
+            with self.nas.block_locks.for_key(block_uuid):
+                block = self.apply(self.nas._read_existing_block(use_backend, block_uuid), patches)
+                self.nas._store_block(use_backend, block_uuid, block)
@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from basic_defs import NAS
+
+logger = logging.getLogger(__name__)
+
+default_socket_path = "/tmp/raid_on_cloud_nas.sock"
+
+#
+# wire format
+#
+#     request:  op (u8), request id (u32), payload length (u32), payload
+#     response: status (u8), request id (u32), payload length (u32), payload
+#
+# clients can send any number of requests before reading responses (pipelining),
+# responses come back in request order and carry the request id
+header = struct.Struct("!BII")
+
+OPEN, READ, WRITE, CLOSE, DELETE, SIZES, FLUSH, SNAPSHOT, CLONE, READ_BYTES = range(1, 11)
+OK_BYTES, OK_TEXT, ERROR, NOT_IMPLEMENTED = range(4)
+
+# keep at most this many requests unanswered (responses are read while requests are still going out, see pipeline())
+pipeline_window = 64
+
+fd_format          = struct.Struct("!q")
+read_args_format   = struct.Struct("!qQQ") # fd, len, offset
+write_args_format  = struct.Struct("!qQ")  # fd, offset (data follows)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _recv_frame(sock):
+    kind, request_id, size = header.unpack(_recv_exactly(sock, header.size))
+    return kind, request_id, _recv_exactly(sock, size)
+
+def _frame(kind, request_id, payload):
+    return header.pack(kind, request_id, len(payload)) + payload
+
+def _filename(payload):
+    # fds are hash(filename), so python2 has to get back the same byte string the client had
+    return payload if str is bytes else payload.decode("utf-8")
+
+def _encode_filename(filename):
+    return filename if isinstance(filename, bytes) else filename.encode("utf-8")
+
+# snapshot/clone take two names, separated by a NUL (an empty snapshot name means the default one)
+def _filenames(payload):
+    first, second = payload.split(b"\0", 1)
+    return _filename(first), _filename(second)
+
+def _encode_filenames(first, second):
+    return _encode_filename(first) + b"\0" + _encode_filename(second or b"")
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        daemon = self.server.nas_daemon
+        while True:
+            try:
+                op, request_id, payload = _recv_frame(self.request)
+            except (EOFError, socket.error):
+                return
+            status, response = daemon.dispatch(op, payload)
+            self.request.sendall(_frame(status, request_id, response))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class NAS_Daemon(object):
+    """
+    Hosts one NAS (and so one set of warm clients, one cache, one journal) for every process on the machine
+    """
+    def __init__(self, nas, socket_path=default_socket_path, serialize=False):
+        self.nas         = nas
+        self.socket_path = socket_path
+        # RAID_on_Cloud and local_NAS are safe to call from every connection's thread at once,
+        # serialize=True is for NAS implementations that aren't
+        self.lock        = threading.Lock() if serialize else None
+        self.server      = None
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = _Server(self.socket_path, _Handler)
+        self.server.nas_daemon = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def dispatch(self, op, payload):
+        """
+        :returns (status, response payload)
+        """
+        try:
+            if self.lock is None:
+                result = self._call(op, payload)
+            else:
+                with self.lock:
+                    result = self._call(op, payload)
+        except NotImplementedError:
+            return NOT_IMPLEMENTED, b""
+        except Exception as error:
+            logger.exception("Request %d failed", op)
+            return ERROR, str(error).encode("utf-8")
+        if result is None:
+            return OK_BYTES, b""
+        if isinstance(result, bytes):
+            return OK_BYTES, result
+        return OK_TEXT, result.encode("utf-8")
+
+    def _call(self, op, payload):
+        nas = self.nas
+        if op == OPEN:
+            return fd_format.pack(nas.open(_filename(payload)))
+        if op == READ:
+            fd, how_many_bytes, offset = read_args_format.unpack(payload)
+            return nas.read(fd, how_many_bytes, offset)
+        if op == READ_BYTES:
+            fd, how_many_bytes, offset = read_args_format.unpack(payload)
+            data = nas.read_bytes(fd, how_many_bytes, offset)
+            # always OK_BYTES, so the client gets back exactly what's stored
+            return data if isinstance(data, bytes) else data.encode("utf-8")
+        if op == WRITE:
+            fd, offset = write_args_format.unpack(payload[:write_args_format.size])
+            # the client already sent utf-8 (or raw bytes), so it's stored as is
+            return nas.write_bytes(fd, payload[write_args_format.size:], offset)
+        if op == CLOSE:
+            return nas.close(fd_format.unpack(payload)[0])
+        if op == DELETE:
+            return nas.delete(_filename(payload))
+        if op == SIZES:
+            return json.dumps(nas.get_storage_sizes()).encode("utf-8")
+        if op == FLUSH:
+            if hasattr(nas, "flush"):
+                nas.flush()
+            return None
+        if op == SNAPSHOT:
+            filename, snapshot_name = _filenames(payload)
+            return nas.snapshot(filename, snapshot_name or None)
+        if op == CLONE:
+            source, destination = _filenames(payload)
+            return nas.clone(source, destination)
+        raise IOError("Unknown request %d" % op)
+
+
+class NAS_Client(NAS):
+    """
+    Thin NAS that forwards every call to a NAS_Daemon
+    pipeline() sends a whole list of calls without waiting for each answer in between
+    """
+    def __init__(self, socket_path=default_socket_path):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.lock = threading.Lock()
+        self.next_request_id = 0
+
+    def open(self, filename):
+        return self.pipeline([("open", filename)])[0]
+
+    def read(self, fd, len, offset):
+        return self.pipeline([("read", fd, len, offset)])[0]
+
+    def read_bytes(self, fd, len, offset):
+        return self.pipeline([("read_bytes", fd, len, offset)])[0]
+
+    def write(self, fd, data, offset):
+        return self.pipeline([("write", fd, data, offset)])[0]
+
+    def close(self, fd):
+        return self.pipeline([("close", fd)])[0]
+
+    def delete(self, filename):
+        return self.pipeline([("delete", filename)])[0]
+
+    def get_storage_sizes(self):
+        return self.pipeline([("get_storage_sizes",)])[0]
+
+    def flush(self):
+        return self.pipeline([("flush",)])[0]
+
+    def snapshot(self, filename, snapshot_name=None):
+        return self.pipeline([("snapshot", filename, snapshot_name)])[0]
+
+    def clone(self, source, destination):
+        return self.pipeline([("clone", source, destination)])[0]
+
+    def disconnect(self):
+        self.sock.close()
+
+    def pipeline(self, calls):
+        """
+        :param calls: [ (method_name, *args) ], ex: [ ("read", fd, 4096, 0), ("read", fd, 4096, 4096) ]
+        :returns the result of every call, in order
+        """
+        with self.lock:
+            if len(calls) == 1:
+                request_ids, responses = self._send_and_receive(calls)
+            else:
+                request_ids, responses = self._send_while_receiving(calls)
+
+        results = []
+        for (status, request_id, payload), expected_id, each in zip(responses, request_ids, calls):
+            if request_id != expected_id:
+                raise IOError("NAS daemon answered request %d, expected %d" % (request_id, expected_id))
+            if status == NOT_IMPLEMENTED:
+                raise NotImplementedError
+            if status == ERROR:
+                raise IOError(payload.decode("utf-8"))
+            results.append(self._decode(each[0], status, payload))
+        return results
+
+    def _send_and_receive(self, calls):
+        # (one call) the daemon reads the whole request before it answers, so nothing to overlap
+        op, payload = self._encode(calls[0][0], calls[0][1:])
+        self.next_request_id = (self.next_request_id + 1) & 0xffffffff
+        self.sock.sendall(_frame(op, self.next_request_id, payload))
+        return [ self.next_request_id ], [ _recv_frame(self.sock) ]
+
+    def _send_while_receiving(self, calls):
+        # responses are read on another thread while we send, otherwise a big response (ex: a large read)
+        # and a big request behind it (ex: a large write) leave both sides blocked in sendall
+        request_ids = []
+        responses = []
+        errors = []
+        received = threading.Condition(threading.Lock())
+        def receive():
+            try:
+                for _ in calls:
+                    frame = _recv_frame(self.sock)
+                    with received:
+                        responses.append(frame)
+                        received.notify_all()
+            except Exception as error:
+                with received:
+                    errors.append(error)
+                    received.notify_all()
+        # (encoded up front, a call we can't encode fails before anything is sent)
+        requests = [ self._encode(each[0], each[1:]) for each in calls ]
+        reader = threading.Thread(target=receive)
+        reader.daemon = True
+        reader.start()
+        try:
+            for op, payload in requests:
+                with received:
+                    while len(request_ids) - len(responses) >= pipeline_window and not errors:
+                        received.wait()
+                    if errors:
+                        break
+                self.next_request_id = (self.next_request_id + 1) & 0xffffffff
+                request_ids.append(self.next_request_id)
+                self.sock.sendall(_frame(op, self.next_request_id, payload))
+        except Exception:
+            # otherwise the reader waits forever for answers to requests we never sent
+            self.sock.shutdown(socket.SHUT_RDWR)
+            reader.join()
+            raise
+        reader.join()
+        if errors:
+            raise errors[0]
+        return request_ids, responses
+
+    def _encode(self, method, args):
+        if method == "open":
+            return OPEN, _encode_filename(args[0])
+        if method == "read":
+            fd, how_many_bytes, offset = args
+            return READ, read_args_format.pack(fd, how_many_bytes, offset)
+        if method == "read_bytes":
+            fd, how_many_bytes, offset = args
+            return READ_BYTES, read_args_format.pack(fd, how_many_bytes, offset)
+        if method == "write":
+            fd, data, offset = args
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            return WRITE, write_args_format.pack(fd, offset) + data
+        if method == "close":
+            return CLOSE, fd_format.pack(args[0])
+        if method == "delete":
+            return DELETE, _encode_filename(args[0])
+        if method == "get_storage_sizes":
+            return SIZES, b""
+        if method == "flush":
+            return FLUSH, b""
+        if method == "snapshot":
+            return SNAPSHOT, _encode_filenames(args[0], args[1])
+        if method == "clone":
+            return CLONE, _encode_filenames(args[0], args[1])
+        raise NotImplementedError
+
+    def _decode(self, method, status, payload):
+        if method == "open":
+            return fd_format.unpack(payload)[0]
+        if method == "read":
+            return payload.decode("utf-8") if status == OK_TEXT else payload
+        if method == "read_bytes":
+            return payload
+        if method == "get_storage_sizes":
+            return json.loads(payload.decode("utf-8"))
+        if method == "snapshot":
+            return _filename(payload)
+        return None
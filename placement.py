@@ -0,0 +1,38 @@
+import hashlib
+
+class Placement(object):
+    """
+    Decides which backends hold the replicas of a block
+        - backends are known by name, so a rebalance can tell which replicas actually moved
+        - 3 backends with 2 replicas is the original mapping (hash(uuid) % 3 picks one of the 3 pairs),
+          so data that's already stored stays where it is
+          (the flip side: leaving that layout, ex: adding a 4th backend, moves ~5/6 of the blocks, once)
+        - any other layout uses rendezvous hashing: each block goes to the backends with the highest
+          hash(name, uuid), so adding/removing a backend only moves the blocks that backend gains/loses
+    """
+    # hash(uuid) % 3 => (use_aws, use_azure, use_gcs)
+    legacy_combos = [
+        (True,  True,  False),
+        (False, True,  True ),
+        (True,  False, True ),
+    ]
+
+    def __init__(self, backend_names, replicas=2):
+        if replicas > len(backend_names):
+            raise ValueError("Can't place %d replicas on %d backends" % (replicas, len(backend_names)))
+        self.backend_names = list(backend_names)
+        self.replicas = replicas
+        self.is_legacy = len(backend_names) == 3 and replicas == 2
+
+    def providers(self, block_uuid):
+        """
+        :returns a bool per backend, True for the ones that hold the block
+        """
+        if self.is_legacy:
+            return self.legacy_combos[hash(block_uuid) % 3]
+        scores = sorted(((hashlib.sha256((name + "/" + str(block_uuid)).encode()).digest(), index) for index, name in enumerate(self.backend_names)), reverse=True)
+        chosen = set(index for _, index in scores[:self.replicas])
+        return tuple(index in chosen for index in range(len(self.backend_names)))
+
+    def replica_names(self, block_uuid):
+        return set(name for name, use_service in zip(self.backend_names, self.providers(block_uuid)) if use_service)
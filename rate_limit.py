@@ -0,0 +1,31 @@
+import threading
+import time
+
+class Rate_Limiter(object):
+    """
+    token bucket: refills at `rate` units per second, holds at most `burst` units
+    a rate of None/0 means unlimited
+    """
+    def __init__(self, rate, burst=None):
+        self.rate     = float(rate or 0)
+        self.capacity = float(burst if burst is not None else (rate or 0))
+        self.tokens   = self.capacity
+        self.updated  = time.time()
+        self.lock     = threading.Lock()
+    
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        # asking for more than the bucket can hold would wait forever,
+        # so those only wait for a full bucket and then drive it negative
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rate_limit import Rate_Limiter
+from resilience import Retrying_Backend
+
+logger = logging.getLogger(__name__)
+
+class Rebalancer(object):
+    """
+    Moves blocks after the backend set or the placement of a RAID_on_Cloud changed
+        - `nas` already has the new backends/placement, old_backends/old_placement is how the blocks are laid out now
+        - only blocks whose replica set changed are copied, the replicas they lost are deleted afterwards
+        - a pool of `parallelism` workers shares the request and bandwidth budgets
+        - progress (the last key done on each old backend) is checkpointed every batch, so an interrupted
+          run picks up where it stopped (all 3 clouds list keys in lexicographic order)
+        - while it runs, reads/writes of blocks that weren't moved yet fall back to the old layout (nas.previous_layout),
+          give the nas a layout_path so that survives restarts and other processes using the same backends see it
+        - going from the original 3 backends/2 replicas to any other layout switches placement to rendezvous hashing
+          (see placement.Placement), so that one time nearly every block moves (~5/6 when adding a 4th backend),
+          later backend changes only move the blocks the added/removed backends gain/lose
+    """
+    def __init__(self, nas, old_backends, old_placement, checkpoint_path=None, parallelism=8, requests_per_second=50, bytes_per_second=8*1024*1024, batch_size=256):
+        self.nas               = nas
+        self.old_placement     = old_placement
+        self.checkpoint_path   = checkpoint_path
+        self.parallelism       = parallelism
+        self.batch_size        = batch_size
+        self.request_limiter   = Rate_Limiter(requests_per_second)
+        self.bandwidth_limiter = Rate_Limiter(bytes_per_second, burst=max(bytes_per_second or 0, nas.block_size))
+        self.stats             = dict(listed=0, moved=0, unchanged=0, copies=0, deletes=0, errors=0)
+        self.stats_lock        = threading.Lock()
+        # backends are matched up by name, the ones we kept are used through the nas (with its retries)
+        self.backends_by_name = dict(zip(nas.placement.backend_names, nas.backends))
+        self.old_backends = []
+        for name, backend in zip(old_placement.backend_names, old_backends):
+            if name not in self.backends_by_name:
+                self.backends_by_name[name] = Retrying_Backend(backend, nas.retry_policy)
+            self.old_backends.append(self.backends_by_name[name])
+
+    def run(self):
+        """
+        :returns the stats (the rebalance is finished if stats["errors"] is 0)
+        """
+        checkpoint = self._read_checkpoint()
+        if self.old_placement.is_legacy and not self.nas.placement.is_legacy:
+            logger.warning("Leaving the original 3 backend layout, most blocks will move this one time")
+        self.nas.set_previous_layout(self.old_backends, self.old_placement)
+        # blocks that failed last time go first
+        failed = []
+        retries = [ str(each) for each in checkpoint["failed"] ]
+        for batch_start in range(0, len(retries), self.batch_size):
+            failed += self._migrate_batch(retries[batch_start:batch_start + self.batch_size])
+        checkpoint["failed"] = failed
+        self._write_checkpoint(checkpoint)
+
+        seen = set()
+        for backend_index, backend in enumerate(self.old_backends):
+            if backend_index < checkpoint["backend"]:
+                continue
+            # (positions would shift as old replicas get deleted, keys don't)
+            done_until = str(checkpoint["after"]) if backend_index == checkpoint["backend"] and checkpoint["after"] is not None else None
+            batch = []
+            for block_uuid in self._paced(backend.iter_blocks()):
+                # there can be non-NAS objects in the buckets, those are always ints
+                if type(block_uuid) != str or block_uuid in seen:
+                    continue
+                if done_until is not None and block_uuid <= done_until:
+                    continue
+                seen.add(block_uuid)
+                batch.append(block_uuid)
+                if len(batch) >= self.batch_size:
+                    checkpoint["failed"] += self._migrate_batch(batch)
+                    checkpoint.update(backend=backend_index, after=max(batch))
+                    self._write_checkpoint(checkpoint)
+                    batch = []
+            checkpoint["failed"] += self._migrate_batch(batch)
+            checkpoint.update(backend=backend_index + 1, after=None)
+            self._write_checkpoint(checkpoint)
+
+        if checkpoint["failed"]:
+            logger.warning("Rebalance left %d block(s) behind, run it again to retry them", len(checkpoint["failed"]))
+            return self.stats
+        # everything is where the new placement wants it
+        self.nas.set_previous_layout(None, None)
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.unlink(self.checkpoint_path)
+        return self.stats
+
+    def migrate(self, block_uuid):
+        """
+        :returns whether the block had to move
+        """
+        old_names = self.old_placement.replica_names(block_uuid)
+        new_names = self.nas.placement.replica_names(block_uuid)
+        self._count("listed")
+        if old_names == new_names:
+            self._count("unchanged")
+            return False
+        # the budget is always taken before the block's lock, waiting for it with the lock held would stall writes to the block
+        # (what's only known once the lock is held, the bandwidth and any extra reads, is paid for after it's released)
+        while True:
+            self.request_limiter.acquire(len(new_names))
+            with self.nas.block_locks.for_key(block_uuid):
+                # otherwise a replica that a quorum write left behind could be picked as the source
+                if self.nas.replication:
+                    self.nas.replication.complete(block_uuid)
+                blocks = dict()
+                for name in sorted(new_names):
+                    blocks[name] = self._read(name, block_uuid)
+                # anything already on a new replica was written since the rebalance started (or copied by an earlier run)
+                source = next((block for block in blocks.values() if block is not None), None)
+                old_reads = 0
+                if source is None:
+                    for name in sorted(old_names - new_names):
+                        old_reads += 1
+                        source = self._read(name, block_uuid)
+                        if source is not None:
+                            break
+                generation = self.nas.block_locks.generation(block_uuid)
+            self.request_limiter.acquire(old_reads)
+            self.bandwidth_limiter.acquire(sum(len(block) for block in blocks.values() if block is not None) + (len(source) if old_reads and source is not None else 0))
+            if source is None:
+                # deleted since it was listed
+                return False
+            missing = [ name for name in sorted(new_names) if blocks[name] is None ]
+            self.request_limiter.acquire(len(missing) + len(old_names - new_names))
+            self.bandwidth_limiter.acquire(len(missing) * len(source))
+            # a write landing between our read and our copy would be undone otherwise
+            with self.nas.block_locks.for_key(block_uuid):
+                if self.nas.block_locks.generation(block_uuid) != generation:
+                    continue
+                for name in missing:
+                    self.backends_by_name[name].write_block(block=source, offset=block_uuid)
+                    self._record_write(name, block_uuid, len(source))
+                    self._count("copies")
+                for name in sorted(old_names - new_names):
+                    try:
+                        self.backends_by_name[name].delete_block(block_uuid)
+                    except Exception as error:
+                        # an orphan replica wastes space but is never read again
+                        logger.warning("Couldn't delete the old replica of '%s' from %s: %s", block_uuid, name, error)
+                        continue
+                    self._record_delete(name, block_uuid)
+                    self._count("deletes")
+            break
+        self._count("moved")
+        return True
+
+    def _migrate_batch(self, block_uuids):
+        """
+        :returns the blocks that couldn't be moved
+        """
+        work = queue.Queue()
+        for each in block_uuids:
+            work.put(each)
+        failed = []
+        def worker():
+            while True:
+                try:
+                    block_uuid = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.migrate(block_uuid)
+                except Exception as error:
+                    logger.warning("Couldn't move block '%s': %s", block_uuid, error)
+                    self._count("errors")
+                    failed.append(block_uuid)
+        threads = [ threading.Thread(target=worker) for _ in range(max(1, min(self.parallelism, len(block_uuids)))) ]
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+        return failed
+
+    def _read(self, name, block_uuid):
+        # (the caller pays for it, see migrate)
+        block = self.backends_by_name[name].read_block(offset=block_uuid)
+        return None if block is None else str(block)
+
+    def _paced(self, block_ids, page_size=1000):
+        # every page of the listing is a request too
+        for index, block_id in enumerate(block_ids):
+            if index % page_size == 0:
+                self.request_limiter.acquire()
+            yield block_id
+
+    def _record_write(self, name, block_uuid, size):
+        if name in self.nas.placement.backend_names:
+            self.nas.inventory.record_write(self.nas.placement.backend_names.index(name), block_uuid, size)
+
+    def _record_delete(self, name, block_uuid):
+        if name in self.nas.placement.backend_names:
+            self.nas.inventory.record_delete(self.nas.placement.backend_names.index(name), block_uuid)
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def _read_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as the_file:
+                return json.load(the_file)
+        return dict(backend=0, after=None, failed=[])
+
+    def _write_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as the_file:
+            json.dump(checkpoint, the_file)
+            the_file.flush()
+            os.fsync(the_file.fileno())
+        os.rename(temp_path, self.checkpoint_path)
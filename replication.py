@@ -0,0 +1,246 @@
+import logging
+import struct
+import threading
+import time
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from journal import Write_Ahead_Log
+
+logger = logging.getLogger(__name__)
+
+class _Uploads(object):
+    # the replica uploads of one store that were still running when it was acknowledged
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.done = threading.Event()
+
+class Replication_Queue(object):
+    """
+    Quorum writes for RAID_on_Cloud: store() returns once one replica has the block and an intent record
+    (the block, the replica that has it, the replicas that are behind) is fsync'd to a local log
+        - the other uploads keep going in the background, the next store of the same block waits for them
+          so an old upload can never land on top of a newer one
+        - replicas that are behind are never read from (see complete_replicas)
+        - a background worker copies the block from an up to date replica to the ones that are behind,
+          which also covers uploads that failed and intents left over from before a restart
+        - uploads run on a fixed pool of `upload_threads` workers per backend, shared by every store();
+          a backend that has `upload_backlog` uploads waiting already is just recorded as behind
+          (so a slow or down backend can't pile up threads or blocks in memory)
+    """
+    record_header = struct.Struct("!BB") # replica that has it, number of replicas behind (their indices and the uuid follow)
+
+    def __init__(self, nas, path, batch_size=64, retry_delay=1.0, upload_threads=8, upload_backlog=256):
+        self.nas         = nas
+        self.batch_size  = batch_size
+        self.retry_delay = retry_delay
+        self.log         = Write_Ahead_Log(path)
+        self.lock        = threading.Condition(threading.Lock())
+        self.lagging     = dict()  # block uuid => indices of the replicas that are behind
+        self.uploading   = dict()  # block uuid => _Uploads
+        self.pending     = deque() # (seq, block uuid) in log order
+        self._stop       = False
+        # backend index => its uploads
+        self.upload_queues = [ queue.Queue(maxsize=upload_backlog) for _ in nas.backends ]
+        self._upload_threads = []
+        for backend_index, upload_queue in enumerate(self.upload_queues):
+            for _ in range(max(1, upload_threads)):
+                thread = threading.Thread(target=self._upload_loop, args=(upload_queue,), name="upload-%d" % backend_index)
+                thread.daemon = True
+                thread.start()
+                self._upload_threads.append(thread)
+        for seq, payload in self.log.pending:
+            block_uuid, good_index, lagging = self._unpack(payload)
+            self._add(seq, block_uuid, lagging)
+        del self.log.pending
+        self._thread = threading.Thread(target=self._replicate_loop, name="replicator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def store(self, use_backend, block_uuid, whole_block):
+        """
+        (caller holds the block's lock)
+        :returns once one replica has the block and the rest are recorded as behind
+        """
+        self._wait_for_uploads(block_uuid)
+        indices = [ index for index, use_service in enumerate(use_backend) if use_service ]
+        results = []
+        finished = threading.Condition(threading.Lock())
+        state = dict(acknowledged=None)
+        def upload(backend_index):
+            error = None
+            try:
+                self.nas.backends[backend_index].write_block(block=whole_block, offset=block_uuid)
+                self.nas.inventory.record_write(backend_index, block_uuid, len(whole_block))
+            except Exception as upload_error:
+                error = upload_error
+            with finished:
+                results.append((backend_index, error))
+                finished.notify_all()
+                uploads = state["acknowledged"]
+            if uploads is not None:
+                # finished after store() returned
+                self._upload_done(block_uuid, uploads, backend_index, error)
+        for backend_index in indices:
+            try:
+                self.upload_queues[backend_index].put_nowait((upload, backend_index))
+            except queue.Full:
+                # that backend is far behind already, the replicator catches this block up with the rest
+                with finished:
+                    results.append((backend_index, IOError("Too many uploads waiting for backend %d" % backend_index)))
+
+        with finished:
+            while not any(error is None for _, error in results) and len(results) < len(indices):
+                finished.wait()
+            if not any(error is None for _, error in results):
+                raise results[-1][1]
+        # uploads that finish after we look report through _upload_done, which waits for self.lock,
+        # so none can finish between us looking and the intent/_Uploads being registered
+        with self.lock:
+            with finished:
+                succeeded = [ backend_index for backend_index, error in results if error is None ]
+                lagging = [ backend_index for backend_index in indices if backend_index not in succeeded ]
+                if not lagging:
+                    return
+                still_running = len(indices) - len(results)
+                uploads = _Uploads(still_running)
+                if still_running:
+                    state["acknowledged"] = uploads
+            # durable before we acknowledge
+            seq = self.log.append(self._pack(block_uuid, succeeded[0], lagging))
+            self._add(seq, block_uuid, lagging)
+            if still_running:
+                self.uploading[block_uuid] = uploads
+            self.lock.notify_all()
+
+    def complete_replicas(self, use_backend, block_uuid):
+        """
+        :returns use_backend without the replicas that are behind
+        """
+        lagging = self.lagging.get(block_uuid, None)
+        if not lagging:
+            return use_backend
+        return tuple(use_service and backend_index not in lagging for backend_index, use_service in enumerate(use_backend))
+
+    def complete(self, block_uuid):
+        """
+        (caller holds the block's lock)
+        copies the block to its replicas that are behind
+        """
+        self._wait_for_uploads(block_uuid)
+        with self.lock:
+            lagging = set(self.lagging.get(block_uuid, ()))
+        if not lagging:
+            return
+        use_backend = self.nas._which_providers(block_uuid)
+        block = None
+        for backend_index, use_service in enumerate(use_backend):
+            if use_service and backend_index not in lagging:
+                block = self.nas.backends[backend_index].read_block(offset=block_uuid)
+                if block is not None:
+                    break
+        if block is None:
+            # deleted since
+            with self.lock:
+                self.lagging.pop(block_uuid, None)
+            return
+        for backend_index in sorted(lagging):
+            self.nas.backends[backend_index].write_block(block=str(block), offset=block_uuid)
+            self.nas.inventory.record_write(backend_index, block_uuid, len(block))
+            with self.lock:
+                self._caught_up(block_uuid, backend_index)
+
+    def flush(self):
+        """
+        blocks until every replica is caught up
+        """
+        with self.lock:
+            while self.pending or self.uploading:
+                self.lock.wait(0.1)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self._stop = True
+            self.lock.notify_all()
+        self._thread.join()
+        for upload_queue in self.upload_queues:
+            for _ in range(len(self._upload_threads) // len(self.upload_queues)):
+                upload_queue.put(None)
+        for thread in self._upload_threads:
+            thread.join()
+        self.log.close()
+
+    def _add(self, seq, block_uuid, lagging):
+        # (lock is held) the newest store decides which replicas are behind
+        self.lagging[block_uuid] = set(lagging)
+        self.pending.append((seq, block_uuid))
+
+    def _caught_up(self, block_uuid, backend_index):
+        # (lock is held)
+        lagging = self.lagging.get(block_uuid, None)
+        if lagging is not None:
+            lagging.discard(backend_index)
+            if not lagging:
+                del self.lagging[block_uuid]
+
+    def _upload_done(self, block_uuid, uploads, backend_index, error):
+        with self.lock:
+            if error is None:
+                self._caught_up(block_uuid, backend_index)
+            else:
+                logger.warning("Upload of block '%s' to backend %d failed, it will be replicated later: %s", block_uuid, backend_index, error)
+            uploads.remaining -= 1
+            if uploads.remaining == 0:
+                if self.uploading.get(block_uuid, None) is uploads:
+                    del self.uploading[block_uuid]
+                uploads.done.set()
+                self.lock.notify_all()
+
+    def _upload_loop(self, upload_queue):
+        while True:
+            task = upload_queue.get()
+            if task is None:
+                return
+            upload, backend_index = task
+            upload(backend_index)
+
+    def _wait_for_uploads(self, block_uuid):
+        uploads = self.uploading.get(block_uuid, None)
+        if uploads is not None:
+            uploads.done.wait()
+
+    def _replicate_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self._stop:
+                    self.lock.wait()
+                if self._stop:
+                    return
+                batch = [ self.pending[index] for index in range(min(self.batch_size, len(self.pending))) ]
+            try:
+                for seq, block_uuid in batch:
+                    with self.nas.block_locks.for_key(block_uuid):
+                        self.complete(block_uuid)
+            except Exception as error:
+                logger.warning("Replication failed, retrying in %ss: %s", self.retry_delay, error)
+                time.sleep(self.retry_delay)
+                continue
+            # checkpoint first, so once flush() sees an empty queue the log agrees
+            self.log.checkpoint(batch[-1][0])
+            with self.lock:
+                for _ in batch:
+                    self.pending.popleft()
+                self.lock.notify_all()
+
+    def _pack(self, block_uuid, good_index, lagging):
+        return self.record_header.pack(good_index, len(lagging)) + bytes(bytearray(lagging)) + block_uuid.encode()
+
+    def _unpack(self, payload):
+        good_index, number_lagging = self.record_header.unpack(payload[:self.record_header.size])
+        lagging_end = self.record_header.size + number_lagging
+        lagging = list(bytearray(payload[self.record_header.size:lagging_end]))
+        return payload[lagging_end:].decode(), good_index, lagging
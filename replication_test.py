@@ -0,0 +1,128 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from basic_defs import cloud_storage
+from cloud import RAID_on_Cloud
+
+#
+# quorum writes (replication.Replication_Queue) against in-memory backends
+#     ./run-tests.sh replication_test
+#
+
+class Memory_Storage(cloud_storage):
+    def __init__(self, write_delay=0):
+        self.blocks = dict()
+        self.write_delay = write_delay
+        self.is_down = False
+
+    def list_blocks(self):
+        return list(self.blocks)
+
+    def read_block(self, offset):
+        block = self.blocks.get(offset, None)
+        return None if block is None else bytearray(block)
+
+    def write_block(self, block, offset):
+        time.sleep(self.write_delay)
+        if self.is_down:
+            raise IOError("down")
+        self.blocks[offset] = str(block)
+
+    def delete_block(self, offset):
+        self.blocks.pop(offset, None)
+
+class Late_Lock(object):
+    # a Condition whose acquire by one thread is held up for a while
+    def __init__(self, lock, thread, delay):
+        self.lock = lock
+        self.thread = thread
+        self.delay = delay
+
+    def __enter__(self):
+        if threading.current_thread() is self.thread:
+            time.sleep(self.delay)
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.lock, name)
+
+class TestQuorumWrites(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_nas(self, backends):
+        return RAID_on_Cloud(backends=backends, write_consistency="quorum", replication_path=self.folder + "/replication.log")
+
+    def assert_flushes(self, nas, timeout=5):
+        thread = threading.Thread(target=nas.flush)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "flush() didn't return")
+
+    def assert_replicas_match(self, nas, backends):
+        for backend in backends:
+            for block_uuid, block in backend.blocks.items():
+                for use_service, other in zip(nas._which_providers(block_uuid), backends):
+                    if use_service:
+                        self.assertEqual(other.blocks.get(block_uuid), block)
+
+    def test_slow_replica_doesnt_hold_up_writes(self):
+        backends = [ Memory_Storage(), Memory_Storage(), Memory_Storage(write_delay=0.5) ]
+        nas = self.make_nas(backends)
+        fd = nas.open("file")
+        started = time.time()
+        nas.write(fd, "a" * 10000, 0)
+        self.assertLess(time.time() - started, 0.4)
+        self.assertEqual(nas.read(fd, 10000, 0), "a" * 10000)
+        self.assert_flushes(nas)
+        self.assert_replicas_match(nas, backends)
+
+    def test_upload_finishing_while_the_intent_is_registered(self):
+        # the lagging upload finishes while the writer is on its way to registering it
+        backends = [ Memory_Storage(), Memory_Storage(), Memory_Storage(write_delay=0.05) ]
+        nas = self.make_nas(backends)
+        nas.replication.lock = Late_Lock(nas.replication.lock, threading.current_thread(), delay=0.1)
+        fd = nas.open("file")
+        nas.write(fd, "b" * 40000, 0)
+        self.assert_flushes(nas)
+        self.assertEqual(nas.replication.uploading, {})
+        self.assertEqual(nas.replication.lagging, {})
+        self.assert_replicas_match(nas, backends)
+
+    def test_overwrite_during_a_slow_upload(self):
+        backends = [ Memory_Storage(), Memory_Storage(), Memory_Storage(write_delay=0.2) ]
+        nas = self.make_nas(backends)
+        fd = nas.open("file")
+        nas.write(fd, "c" * 8192, 0)
+        nas.write(fd, "d" * 8192, 0)
+        self.assertEqual(nas.read(fd, 8192, 0), "d" * 8192)
+        self.assert_flushes(nas)
+        self.assert_replicas_match(nas, backends)
+
+    def test_pending_replication_survives_a_restart(self):
+        backends = [ Memory_Storage(), Memory_Storage(), Memory_Storage() ]
+        backends[2].is_down = True
+        nas = self.make_nas(backends)
+        # (so this one doesn't catch up before the "restart")
+        nas.replication.retry_delay = 60
+        fd = nas.open("file")
+        nas.write(fd, "e" * 40000, 0)
+        self.assertEqual(nas.read(fd, 40000, 0), "e" * 40000)
+        backends[2].is_down = False
+        restarted = self.make_nas(backends)
+        self.assertTrue(restarted.replication.pending)
+        self.assert_flushes(restarted)
+        self.assert_replicas_match(restarted, backends)
+
+if __name__ == '__main__':
+    unittest.main()
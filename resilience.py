@@ -0,0 +1,207 @@
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+from basic_defs import cloud_storage
+
+logger = logging.getLogger(__name__)
+
+THROTTLED, TRANSIENT, PERMANENT = "throttled", "transient", "permanent"
+
+# error codes the providers use when they want us to slow down
+throttle_codes = set([
+    "SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+    "TooManyRequestsException", "RequestThrottled", "ServerBusy", "OperationTimedOut",
+])
+transient_statuses = set([ 408, 500, 502, 503, 504 ])
+transient_errnos = set([ errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.EPIPE, errno.ETIMEDOUT, errno.EHOSTUNREACH ])
+
+def _status_and_code(error):
+    """
+    digs the http status and error code out of a boto/azure/google exception without importing any of them
+    """
+    response = getattr(error, "response", None)
+    if isinstance(response, dict): # botocore ClientError
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode"), response.get("Error", {}).get("Code")
+    status = getattr(error, "status_code", None) # azure HttpResponseError
+    if status is None and isinstance(getattr(error, "code", None), int): # google GoogleAPICallError
+        status = error.code
+    return status, getattr(error, "error_code", None)
+
+def classify(error):
+    status, code = _status_and_code(error)
+    if status == 429 or code in throttle_codes:
+        return THROTTLED
+    if status in transient_statuses:
+        return TRANSIENT
+    if status is None:
+        # no http response at all: the connection itself failed
+        if isinstance(error, socket.timeout) or getattr(error, "errno", None) in transient_errnos:
+            return TRANSIENT
+        if type(error).__name__ in ("ServiceRequestError", "ServiceResponseError", "EndpointConnectionError", "ConnectionClosedError", "ReadTimeoutError", "ConnectTimeoutError", "ConnectionError"):
+            return TRANSIENT
+    return PERMANENT
+
+def retry_after(error):
+    """
+    :returns the seconds the provider asked us to wait (Retry-After header), or None
+    """
+    headers = None
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders")
+    elif response is not None:
+        headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    for name in ("retry-after", "Retry-After", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) / (1000.0 if name.endswith("-ms") else 1.0)
+            except ValueError:
+                return None
+    return None
+
+
+class Retry_Policy(object):
+    """
+    retries throttled/transient errors with jittered exponential backoff (full jitter)
+    throttling waits what the provider asked for, or backs off from a bigger base
+    """
+    def __init__(self, max_attempts=5, base_delay=0.1, max_delay=10.0, throttle_base_delay=1.0):
+        self.max_attempts        = max_attempts
+        self.base_delay          = base_delay
+        self.max_delay           = max_delay
+        self.throttle_base_delay = throttle_base_delay
+
+    def delay(self, attempt, error, kind):
+        requested = retry_after(error) if kind == THROTTLED else None
+        if requested is not None:
+            return min(requested, self.max_delay)
+        base = self.throttle_base_delay if kind == THROTTLED else self.base_delay
+        return random.uniform(0, min(self.max_delay, base * (2 ** attempt)))
+
+
+class Retrying_Backend(cloud_storage):
+    """
+    Wraps a backend so every call goes through a Retry_Policy
+    when the provider throttles, every caller of this backend waits, not just the one that got throttled
+    """
+    def __init__(self, backend, policy=None):
+        self.backend = backend
+        self.policy = policy or Retry_Policy()
+        self.paused_until = 0
+
+    def list_blocks(self):
+        return self._call(self.backend.list_blocks)
+
+    def read_block(self, offset):
+        return self._call(self.backend.read_block, offset)
+
+    def read_range(self, offset, start, end):
+        return self._call(self.backend.read_range, offset, start, end)
+
+    def write_block(self, block, offset):
+        return self._call(self.backend.write_block, block, offset)
+
+    def delete_block(self, offset):
+        return self._call(self.backend.delete_block, offset)
+
+    def iter_blocks(self, prefix=None, page_size=1000):
+        return self._iterate(self.backend.iter_blocks, prefix, page_size, lambda block_id: block_id)
+
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        return self._iterate(self.backend.iter_block_sizes, prefix, page_size, lambda each: each[0])
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _call(self, function, *args):
+        attempt = 0
+        while True:
+            self._wait_if_paused()
+            try:
+                return function(*args)
+            except Exception as error:
+                attempt += 1
+                self._back_off(function, attempt, error)
+
+    def _iterate(self, function, prefix, page_size, block_id_of):
+        # a listing that fails part way is listed again, skipping what was already yielded
+        # (all 3 clouds list keys in lexicographic order), anything yielded since the last failure resets the attempts
+        done_until = None
+        resume_after = None
+        attempt = 0
+        while True:
+            self._wait_if_paused()
+            try:
+                for each in function(prefix=prefix, page_size=page_size):
+                    block_id = str(block_id_of(each))
+                    if resume_after is not None and block_id <= resume_after:
+                        continue
+                    done_until = block_id
+                    attempt = 0
+                    yield each
+                return
+            except Exception as error:
+                attempt += 1
+                self._back_off(function, attempt, error)
+                resume_after = done_until
+
+    def _wait_if_paused(self):
+        wait = self.paused_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _back_off(self, function, attempt, error):
+        # (called from the except block, re-raises the error if it shouldn't be retried)
+        kind = classify(error)
+        if kind == PERMANENT or attempt >= self.policy.max_attempts:
+            raise
+        delay = self.policy.delay(attempt, error, kind)
+        if kind == THROTTLED:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+        logger.info("%s failed (%s), retry %d in %.2fs: %s", getattr(function, "__name__", "call"), kind, attempt, delay, error)
+        time.sleep(delay)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Single_Flight(object):
+    """
+    Concurrent do(key, function) calls for the same key share one call of function
+    (so N readers of the same block cause one GET instead of N)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key, None)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = _Call()
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
@@ -1,8 +1,13 @@
 #!/bin/sh
 
+top_level_tests="stress_test replication_test"
+
 if [ "$#" -eq 0 ]; then
 	set -x
-	PYTHONPATH=$PWD/lib:$PWD python -m unittest discover tests -v
+	PYTHONPATH=$PWD/lib:$PWD python -m unittest discover tests -v || status=1
+	# tests that live next to the code rather than in the tests submodule
+	PYTHONPATH=$PWD/lib:$PWD python -m unittest -v $top_level_tests || status=1
+	exit ${status:-0}
 else
 	set -x
 	PYTHONPATH=$PWD/lib:$PWD python -m unittest -v $*
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rate_limit import Rate_Limiter
+
+logger = logging.getLogger(__name__)
+
+class Scrubber(object):
+    """
+    Background worker that puts lost/stale replicas of a RAID_on_Cloud back
+        - blocks that reads found missing (nas.repair_queue) are repaired first
+        - every `interval` seconds it walks the listing of every backend and checks every block
+    all backend traffic goes through the request and bandwidth budgets so it stays out of the way of foreground I/O
+    """
+    def __init__(self, nas, requests_per_second=10, bytes_per_second=1024*1024, interval=60*60):
+        self.nas               = nas
+        self.interval          = interval
+        self.request_limiter   = Rate_Limiter(requests_per_second)
+        self.bandwidth_limiter = Rate_Limiter(bytes_per_second, burst=max(bytes_per_second or 0, nas.block_size))
+        self.stats             = dict(checked=0, repaired=0, errors=0, passes=0)
+        self._stop             = threading.Event()
+        self._thread           = None
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="scrubber")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def run(self):
+        next_pass = time.time()
+        while not self._stop.is_set():
+            self.drain_repairs(timeout=1)
+            if time.time() >= next_pass:
+                self.scrub_all()
+                next_pass = time.time() + self.interval
+    
+    def drain_repairs(self, timeout=0):
+        """
+        repairs everything reads have queued so far, waiting at most `timeout` seconds for the first one
+        """
+        while not self._stop.is_set():
+            try:
+                block_uuid = self.nas.repair_queue.get(timeout=timeout) if timeout else self.nas.repair_queue.get_nowait()
+            except queue.Empty:
+                return
+            timeout = 0
+            self._check(block_uuid)
+    
+    def scrub_all(self):
+        seen = set()
+        for backend in self.nas.backends:
+            for block_uuid in self._paced(backend.iter_blocks()):
+                if self._stop.is_set():
+                    return
+                # there can be non-NAS objects in the buckets, those are always ints
+                if type(block_uuid) != str or block_uuid in seen:
+                    continue
+                seen.add(block_uuid)
+                self._check(block_uuid)
+                # repairs found by reads shouldn't wait for a whole pass
+                self.drain_repairs()
+        self.stats["passes"] += 1
+    
+    def repair(self, block_uuid):
+        """
+        :returns the number of replicas that were re-uploaded
+        """
+        # the budget is always taken before the block's lock, waiting for it with the lock held would stall writes to the block
+        while True:
+            replica_count = sum(1 for use_service in self.nas._which_providers(block_uuid) if use_service)
+            self.request_limiter.acquire(replica_count)
+            with self.nas.block_locks.for_key(block_uuid):
+                # a replica that a quorum write left behind isn't damaged, just not caught up yet
+                if self.nas.replication:
+                    self.nas.replication.complete(block_uuid)
+                replicas = self._read_replicas(block_uuid)
+                generation = self.nas.block_locks.generation(block_uuid)
+            # (bandwidth is only known once the replicas are read, so that's paid for afterwards)
+            self.bandwidth_limiter.acquire(sum(len(block) for _, _, block in replicas if block is not None))
+            good_copy, damaged = self._compare(replicas)
+            if not damaged:
+                return 0
+            self.request_limiter.acquire(len(damaged))
+            self.bandwidth_limiter.acquire(len(damaged) * len(good_copy))
+            with self.nas.block_locks.for_key(block_uuid):
+                # a write landing since we read would be undone by re-uploading what we read, so look again
+                if self.nas.block_locks.generation(block_uuid) != generation:
+                    continue
+                for backend_index, backend in damaged:
+                    backend.write_block(block=good_copy, offset=block_uuid)
+                    self.nas.inventory.record_write(backend_index, block_uuid, len(good_copy))
+                return len(damaged)
+    
+    def _read_replicas(self, block_uuid):
+        replicas = []
+        for backend_index, (use_service, backend) in enumerate(zip(self.nas._which_providers(block_uuid), self.nas.backends)):
+            if use_service:
+                block = backend.read_block(offset=block_uuid)
+                replicas.append((backend_index, backend, None if block is None else str(block)))
+        return replicas
+    
+    def _compare(self, replicas):
+        """
+        :returns (the good copy, [ (backend index, backend) of the replicas that don't match it ])
+        """
+        # reads are served from the first replica that has the block, so that's the copy clients already see
+        good_copies = [ block for _, _, block in replicas if block is not None ]
+        if not good_copies:
+            # nothing to repair from (most likely it was deleted)
+            return None, []
+        good_copy = good_copies[0]
+        good_checksum = hashlib.md5(good_copy).digest()
+        damaged = [ (backend_index, backend) for backend_index, backend, block in replicas if block is None or hashlib.md5(block).digest() != good_checksum ]
+        return good_copy, damaged
+    
+    def _paced(self, block_ids, page_size=1000):
+        # every page of the listing is a request too
+        for index, block_id in enumerate(block_ids):
+            if index % page_size == 0:
+                self.request_limiter.acquire()
+            yield block_id
+    
+    def _check(self, block_uuid):
+        self.stats["checked"] += 1
+        try:
+            self.stats["repaired"] += self.repair(block_uuid)
+        except Exception as error:
+            self.stats["errors"] += 1
+            logger.warning("Couldn't scrub block '%s': %s", block_uuid, error)
@@ -0,0 +1,185 @@
+import json
+import os
+import random
+import threading
+
+class Layer_Map(object):
+    """
+    Which layers make up each snapshotted/cloned file, and which blocks each layer has
+        - a layer is a set of blocks stored under its own id (the id takes the place of the fd in block uuids)
+        - a file's chain is its layers, newest first: a block is read from the newest layer that has it,
+          and written to the newest layer (after copying it up, if only an older layer has it)
+        - a file's own fd can be the bottom of its chain, those blocks were written before anyone tracked them
+          so that layer is assumed to have every block
+        - snapshot/clone only add layers, so they cost the same no matter how big the file is
+    files that were never snapshotted/cloned have no entry, their fd is their only layer
+
+    on disk (in `path`):
+        files.json      fd => { name, chain, read_only }, rewritten atomically
+        <layer>.blocks  the block numbers of a layer, appended (and fsync'd) once the block is stored (or journaled),
+                        until then reads keep going to the older layer that has it
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock = threading.Lock()
+        self.files = dict()   # fd => { "name": ..., "chain": [ layer, ... ], "read_only": bool }
+        self.blocks = dict()  # layer => bitmap of block numbers
+        self.appenders = dict()
+        files_path = os.path.join(path, "files.json")
+        if os.path.exists(files_path):
+            with open(files_path) as the_file:
+                for fd, entry in json.load(the_file).items():
+                    self.files[int(fd)] = entry
+        for each in os.listdir(path):
+            if each.endswith(".blocks"):
+                self.blocks[int(each[:-len(".blocks")])] = self._read_bitmap(os.path.join(path, each))
+
+    def chain(self, fd):
+        entry = self.files.get(fd, None)
+        return None if entry is None else entry["chain"]
+
+    def is_read_only(self, fd):
+        entry = self.files.get(fd, None)
+        return entry is not None and entry["read_only"]
+
+    def has(self, layer, block_number):
+        bitmap = self.blocks.get(layer, None)
+        if bitmap is None:
+            # an untracked (pre-snapshot) layer
+            return True
+        byte_index = block_number >> 3
+        return byte_index < len(bitmap) and bool(bitmap[byte_index] & (1 << (block_number & 7)))
+
+    def resolve(self, fd, block_number):
+        """
+        :returns the layer that block_number of the file should be read from
+        """
+        entry = self.files.get(fd, None)
+        if entry is None:
+            return fd
+        chain = entry["chain"]
+        for layer in chain:
+            if self.has(layer, block_number):
+                return layer
+        # never written, same as a block past the end of a plain file
+        return chain[0]
+
+    def claim(self, layer, block_number):
+        """
+        records that `layer` has the block (call it after the block is stored/journaled)
+        """
+        with self.lock:
+            if self.has(layer, block_number):
+                return
+            appender = self.appenders.get(layer, None)
+            if appender is None:
+                appender = self.appenders[layer] = os.open(self._blocks_path(layer), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            os.write(appender, ("%d\n" % block_number).encode())
+            os.fsync(appender)
+            bitmap = self.blocks[layer]
+            byte_index = block_number >> 3
+            if byte_index >= len(bitmap):
+                bitmap.extend(bytearray(byte_index + 1 - len(bitmap)))
+            bitmap[byte_index] |= 1 << (block_number & 7)
+
+    def snapshot(self, fd, snapshot_fd, snapshot_name):
+        """
+        the snapshot gets the file's current chain (read only), the file gets a new, empty layer on top of it
+        """
+        with self.lock:
+            if snapshot_fd in self.files:
+                raise IOError("'%s' already exists" % snapshot_name)
+            chain = self._freeze(fd)
+            self.files[snapshot_fd] = dict(name=snapshot_name, chain=chain, read_only=True)
+            self._save()
+
+    def clone(self, fd, clone_fd, clone_name):
+        """
+        both files get a new, empty layer on top of the file's current chain
+        """
+        with self.lock:
+            chain = self._freeze(fd)
+            replaced = self.files.get(clone_fd, None)
+            self.files[clone_fd] = dict(name=clone_name, chain=[ self._new_layer() ] + chain, read_only=False)
+            if replaced is not None:
+                in_use = set(layer for each in self.files.values() for layer in each["chain"])
+                for layer in replaced["chain"]:
+                    if layer not in in_use:
+                        self._forget_layer(layer)
+            self._save()
+
+    def remove(self, fd, name):
+        """
+        forgets the file
+        :returns the layers nothing uses anymore (their blocks can be deleted)
+        """
+        with self.lock:
+            entry = self.files.pop(fd, None)
+            chain = [ fd ] if entry is None else entry["chain"]
+            in_use = set(layer for each in self.files.values() for layer in each["chain"])
+            if fd in in_use:
+                # the file's old blocks live on in a snapshot/clone, so if the file is
+                # written again it has to start from a new layer instead of writing over them
+                self.files[fd] = dict(name=name, chain=[ self._new_layer() ], read_only=False)
+            unused = [ layer for layer in chain if layer not in in_use ]
+            for layer in unused:
+                self._forget_layer(layer)
+            if entry is not None or fd in in_use:
+                self._save()
+            return unused
+
+    def _freeze(self, fd):
+        """
+        :returns the file's current chain, after moving the file itself onto a new layer
+        """
+        entry = self.files.get(fd, None)
+        if entry is None:
+            entry = self.files[fd] = dict(name=None, chain=[ fd ], read_only=False)
+        chain = entry["chain"]
+        if not entry["read_only"]:
+            entry["chain"] = [ self._new_layer() ] + chain
+        return chain
+
+    def _new_layer(self):
+        layer = random.getrandbits(63)
+        while layer in self.blocks or layer in self.files:
+            layer = random.getrandbits(63)
+        self.blocks[layer] = bytearray()
+        open(self._blocks_path(layer), "a").close()
+        return layer
+
+    def _forget_layer(self, layer):
+        self.blocks.pop(layer, None)
+        appender = self.appenders.pop(layer, None)
+        if appender is not None:
+            os.close(appender)
+        if os.path.exists(self._blocks_path(layer)):
+            os.unlink(self._blocks_path(layer))
+
+    def _save(self):
+        temp_path = os.path.join(self.path, "files.json.tmp")
+        with open(temp_path, "w") as the_file:
+            json.dump(dict((str(fd), entry) for fd, entry in self.files.items()), the_file)
+            the_file.flush()
+            os.fsync(the_file.fileno())
+        os.rename(temp_path, os.path.join(self.path, "files.json"))
+
+    def _blocks_path(self, layer):
+        return os.path.join(self.path, "%d.blocks" % layer)
+
+    def _read_bitmap(self, blocks_path):
+        bitmap = bytearray()
+        with open(blocks_path) as the_file:
+            for line in the_file:
+                try:
+                    block_number = int(line)
+                except ValueError:
+                    # torn last line
+                    continue
+                byte_index = block_number >> 3
+                if byte_index >= len(bitmap):
+                    bitmap.extend(bytearray(byte_index + 1 - len(bitmap)))
+                bitmap[byte_index] |= 1 << (block_number & 7)
+        return bitmap
@@ -0,0 +1,96 @@
+import random
+import shutil
+import string
+import tempfile
+import threading
+import time
+import unittest
+
+from basic_defs import cloud_storage
+from cloud import RAID_on_Cloud
+
+#
+# concurrent writers on shared/adjacent blocks (the striped block locks in RAID_on_Cloud)
+#     ./run-tests.sh stress_test
+#
+#     every pair of writers shares a block: A writes from the middle of block X to the end of block X+1,
+#     B writes the start of block X (so B's write ends there and cuts the block off after it)
+#     after each round block X has to look like A then B, or B then A,
+#     a lost update (A's read-modify-write straddling B's) leaves the previous round's data in it instead
+#
+
+class Jittery_Storage(cloud_storage):
+    # in-memory, with a little delay on every call so read-modify-writes overlap
+    def __init__(self):
+        self.blocks = dict()
+        self.lock = threading.Lock()
+
+    def list_blocks(self):
+        with self.lock:
+            return list(self.blocks)
+
+    def read_block(self, offset):
+        time.sleep(random.random() * 0.002)
+        with self.lock:
+            block = self.blocks.get(offset, None)
+        return None if block is None else bytearray(block)
+
+    def write_block(self, block, offset):
+        time.sleep(random.random() * 0.002)
+        with self.lock:
+            self.blocks[offset] = str(block)
+
+    def delete_block(self, offset):
+        with self.lock:
+            self.blocks.pop(offset, None)
+
+class TestConcurrentWriters(unittest.TestCase):
+    block_size = 4096
+    pairs      = 8
+    rounds     = 20
+    split      = 1000 # where in the shared block A starts and B ends
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_rounds(self, nas):
+        fd = nas.open("stress")
+        letters = string.ascii_letters
+        for round_number in range(self.rounds):
+            a_letter = letters[(2 * round_number) % len(letters)]
+            b_letter = letters[(2 * round_number + 1) % len(letters)]
+            threads = []
+            for pair in range(self.pairs):
+                shared = pair * 2 * self.block_size
+                threads.append(threading.Thread(target=nas.write, args=(fd, a_letter * (2 * self.block_size - self.split), shared + self.split)))
+                threads.append(threading.Thread(target=nas.write, args=(fd, b_letter * self.split, shared)))
+            random.shuffle(threads)
+            for each in threads:
+                each.start()
+            for each in threads:
+                each.join()
+            if hasattr(nas, "flush"):
+                nas.flush()
+            a_then_b = b_letter * self.split
+            b_then_a = b_letter * self.split + a_letter * (self.block_size - self.split)
+            for pair in range(self.pairs):
+                shared = pair * 2 * self.block_size
+                block = nas.read(fd, self.block_size, shared)
+                self.assertIn(block, (a_then_b, b_then_a), "round %d, pair %d: %r" % (round_number, pair, block[:8] + "..." + block[-8:]))
+                # only A writes the block after it
+                self.assertEqual(nas.read(fd, self.block_size, shared + self.block_size), a_letter * self.block_size)
+
+    def test_shared_and_adjacent_blocks(self):
+        self.run_rounds(RAID_on_Cloud(backends=[ Jittery_Storage() for _ in range(3) ]))
+
+    def test_shared_and_adjacent_blocks_with_a_journal(self):
+        self.run_rounds(RAID_on_Cloud(backends=[ Jittery_Storage() for _ in range(3) ], journal_path=self.folder + "/journal"))
+
+    def test_shared_and_adjacent_blocks_with_quorum_writes(self):
+        self.run_rounds(RAID_on_Cloud(backends=[ Jittery_Storage() for _ in range(3) ], write_consistency="quorum", replication_path=self.folder + "/replication.log"))
+
+if __name__ == '__main__':
+    unittest.main()
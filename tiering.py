@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class Hot_Tier(object):
+    """
+    Keeps frequently accessed blocks on a local store (ex: cloud.Local_Disk_Storage) in front of the clouds
+        - it's write-through: the clouds always have every block, so demoting a block just drops the local copy
+        - admission: a block is only copied in once it has been accessed `admit_after` times
+        - eviction: least frequently used first, counts are halved every `aging_interval` seconds
+          so blocks that were hot a long time ago don't stay forever
+        - a background thread demotes blocks whenever the tier is over capacity (down to `low_watermark` of it)
+        - it starts out empty: whatever a previous run left in the store is dropped, since anything could have
+          written to the clouds while the tier wasn't attached (another run, another host, the rebalancer, the scrubber)
+    """
+    def __init__(self, store, capacity_bytes=256*1024*1024, admit_after=2, aging_interval=5*60, low_watermark=0.9):
+        self.store          = store
+        self.capacity_bytes = capacity_bytes
+        self.admit_after    = admit_after
+        self.aging_interval = aging_interval
+        self.low_watermark  = low_watermark
+        self.lock           = threading.Condition(threading.Lock())
+        self.frequency      = dict() # block id => access count (resident or not)
+        self.resident       = dict() # block id => size
+        self.versions       = dict() # block id => number of writes, so a stale read can't be admitted
+        # checking a block's version and storing/dropping it happen under the block's stripe of these,
+        # otherwise a stale read that passed the check could land after a write's copy
+        self.block_locks    = [ threading.Lock() for _ in range(256) ]
+        self.used_bytes     = 0
+        self.last_aging     = time.time()
+        self.counters       = dict(hits=0, misses=0, local_bytes=0, cloud_bytes=0, admitted=0, demoted=0)
+        for block_id in list(store.iter_blocks()):
+            self._drop(block_id)
+        self._thread = threading.Thread(target=self._demote_loop, name="hot-tier-demoter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self, block_id):
+        """
+        :returns the block if it's in the tier, None otherwise (either way it counts as an access)
+        """
+        with self.lock:
+            self._touch(block_id)
+            is_resident = block_id in self.resident
+        block = self.store.read_block(block_id) if is_resident else None
+        with self.lock:
+            if block is None:
+                self.counters["misses"] += 1
+            else:
+                self.counters["hits"] += 1
+                self.counters["local_bytes"] += len(block)
+        return block
+
+    def would_admit(self, block_id):
+        """
+        whether a copy of the block would be kept if it was offer()'d now
+        """
+        with self.lock:
+            return block_id not in self.resident and self.frequency.get(block_id, 0) >= self.admit_after
+
+    def count_cloud_bytes(self, number_of_bytes):
+        # bytes that were read from the clouds without going through offer() (ex: ranged reads)
+        with self.lock:
+            self.counters["cloud_bytes"] += number_of_bytes
+
+    def version(self, block_id):
+        with self.lock:
+            return self.versions.get(block_id, 0)
+
+    def offer(self, block_id, block, version):
+        """
+        called with a block that was just read from the clouds, `version` is what version() was before that read
+        """
+        with self._lock_for(block_id):
+            with self.lock:
+                self.counters["cloud_bytes"] += len(block)
+                if self.versions.get(block_id, 0) != version or block_id in self.resident:
+                    return
+                if self.frequency.get(block_id, 0) < self.admit_after:
+                    return
+            self._put(block_id, block)
+        with self.lock:
+            self.counters["admitted"] += 1
+
+    def update(self, block_id, block):
+        """
+        called after a block was written to the clouds
+        (not an access by itself, the read half of the read-modify-write already counted)
+        """
+        with self._lock_for(block_id):
+            with self.lock:
+                self.versions[block_id] = self.versions.get(block_id, 0) + 1
+                should_store = block_id in self.resident or self.frequency.get(block_id, 0) >= self.admit_after
+            if should_store:
+                self._put(block_id, block)
+
+    def invalidate(self, block_id):
+        with self._lock_for(block_id):
+            with self.lock:
+                self.versions[block_id] = self.versions.get(block_id, 0) + 1
+                self.frequency.pop(block_id, None)
+                size = self.resident.pop(block_id, None)
+                if size is None:
+                    return
+                self.used_bytes -= size
+            self._drop(block_id)
+
+    def invalidate_prefix(self, prefix):
+        with self.lock:
+            block_ids = [ each for each in self.resident if str(each).startswith(prefix) ]
+        for block_id in block_ids:
+            self.invalidate(block_id)
+
+    def stats(self):
+        with self.lock:
+            output = dict(self.counters)
+            accesses = output["hits"] + output["misses"]
+            output["hit_ratio"] = (float(output["hits"]) / accesses) if accesses else 0.0
+            output["resident_blocks"] = len(self.resident)
+            output["used_bytes"] = self.used_bytes
+            output["capacity_bytes"] = self.capacity_bytes
+            return output
+
+    def _lock_for(self, block_id):
+        return self.block_locks[hash(block_id) % len(self.block_locks)]
+
+    def _touch(self, block_id):
+        # (lock is held)
+        self.frequency[block_id] = self.frequency.get(block_id, 0) + 1
+        if time.time() - self.last_aging > self.aging_interval:
+            self.last_aging = time.time()
+            for each, count in list(self.frequency.items()):
+                if count > 1 or each in self.resident:
+                    self.frequency[each] = count // 2
+                else:
+                    del self.frequency[each]
+
+    def _put(self, block_id, block):
+        self.store.write_block(block, block_id)
+        with self.lock:
+            self.used_bytes += len(block) - self.resident.get(block_id, 0)
+            self.resident[block_id] = len(block)
+            if self.used_bytes > self.capacity_bytes:
+                self.lock.notify_all()
+
+    def _drop(self, block_id):
+        try:
+            self.store.delete_block(block_id)
+        except Exception as error:
+            logger.warning("Couldn't drop '%s' from the hot tier: %s", block_id, error)
+
+    def _demote_loop(self):
+        while True:
+            with self.lock:
+                while self.used_bytes <= self.capacity_bytes:
+                    self.lock.wait(self.aging_interval)
+                target = self.capacity_bytes * self.low_watermark
+                coldest_first = sorted(self.resident, key=lambda each: self.frequency.get(each, 0))
+                victims = []
+                for block_id in coldest_first:
+                    if self.used_bytes <= target:
+                        break
+                    self.used_bytes -= self.resident.pop(block_id)
+                    self.versions[block_id] = self.versions.get(block_id, 0) + 1
+                    victims.append(block_id)
+                self.counters["demoted"] += len(victims)
+            for block_id in victims:
+                with self._lock_for(block_id):
+                    with self.lock:
+                        # a write stored it again since
+                        if block_id in self.resident:
+                            continue
+                    self._drop(block_id)
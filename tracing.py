@@ -0,0 +1,185 @@
+import json
+import os
+import random
+import threading
+import time
+
+from basic_defs import cloud_storage
+
+#
+# opt-in tracing
+#
+#     with tracer.span("read", fd=fd):
+#         with tracer.span("plan"):
+#             ...
+#
+#     spans nest per thread, whole traces (a root span and everything under it) are kept or
+#     dropped together, so sample_rate=0.01 costs ~nothing for 99% of the operations
+#     export() writes chrome trace-event json (chrome://tracing, perfetto, speedscope)
+#     or collapsed stacks (flamegraph.pl, speedscope), ex: "read;block;fetch;aws.read_block 1234"
+#
+formats = ("chrome", "collapsed")
+
+class _Null_Span(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_null_span = _Null_Span()
+
+class Null_Tracer(object):
+    """
+    What the engine uses when tracing is off
+    """
+    enabled = False
+    def span(self, name, **args):
+        return _null_span
+
+null_tracer = Null_Tracer()
+
+class _Unsampled_Root(object):
+    # marks the thread's stack so everything under this root is skipped too
+    def __init__(self, stack):
+        self.stack = stack
+    def __enter__(self):
+        self.stack.append(None)
+        return self
+    def __exit__(self, *args):
+        self.stack.pop()
+        return False
+
+class _Span(object):
+    def __init__(self, tracer, stack, name, args):
+        self.tracer = tracer
+        self.stack  = stack
+        self.name   = name
+        self.args   = args
+
+    def __enter__(self):
+        self.child_time = 0.0
+        self.stack.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.time() - self.started
+        path = tuple(each.name for each in self.stack)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].child_time += duration
+        self.tracer._record(path, self.started, duration, duration - self.child_time, self.args)
+        return False
+
+class Tracer(object):
+    """
+    Records nested spans (see the top of this file)
+    at most max_spans are kept, later ones are only counted in self.dropped
+    """
+    enabled = True
+
+    def __init__(self, sample_rate=1.0, max_spans=1000000):
+        self.sample_rate = sample_rate
+        self.max_spans   = max_spans
+        self.started     = time.time()
+        self.spans       = [] # (path, thread id, start, duration, self time, args)
+        self.dropped     = 0
+        self.lock        = threading.Lock()
+        self.local       = threading.local()
+
+    def span(self, name, **args):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        if stack:
+            if stack[0] is None:
+                return _null_span
+        elif random.random() >= self.sample_rate:
+            return _Unsampled_Root(stack)
+        return _Span(self, stack, name, args)
+
+    def export(self, path, format="chrome"):
+        if format == "chrome":
+            self.write_chrome_trace(path)
+        elif format == "collapsed":
+            self.write_collapsed_stacks(path)
+        else:
+            raise ValueError("Unknown trace format '%s', expected one of %s" % (format, ", ".join(formats)))
+
+    def write_chrome_trace(self, path):
+        with self.lock:
+            spans = list(self.spans)
+        process_id = os.getpid()
+        events = []
+        for span_path, thread_id, start, duration, self_time, args in spans:
+            events.append(dict(
+                name=span_path[-1],
+                cat="nas",
+                ph="X",
+                ts=int((start - self.started) * 1e6),
+                dur=int(duration * 1e6),
+                pid=process_id,
+                tid=thread_id,
+                args=dict((key, str(value)) for key, value in args.items()),
+            ))
+        with open(path, "w") as the_file:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms", otherData=dict(dropped_spans=self.dropped)), the_file)
+
+    def write_collapsed_stacks(self, path):
+        """
+        one line per distinct stack: the frames joined by ';' then the self time in microseconds
+        """
+        with self.lock:
+            spans = list(self.spans)
+        totals = dict()
+        for span_path, thread_id, start, duration, self_time, args in spans:
+            totals[span_path] = totals.get(span_path, 0.0) + self_time
+        with open(path, "w") as the_file:
+            for span_path, self_time in sorted(totals.items()):
+                the_file.write("%s %d\n" % (";".join(span_path), max(0, int(self_time * 1e6))))
+
+    def _record(self, path, start, duration, self_time, args):
+        with self.lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            self.spans.append((path, threading.current_thread().ident, start, duration, self_time, args))
+
+
+class Traced_Backend(cloud_storage):
+    """
+    Wraps a backend so every call is a span named after the backend, ex: "aws.read_block"
+    """
+    def __init__(self, backend, tracer, name):
+        self.backend = backend
+        self.tracer  = tracer
+        self.name    = name
+
+    def list_blocks(self):
+        with self.tracer.span(self.name + ".list_blocks"):
+            return self.backend.list_blocks()
+
+    def read_block(self, offset):
+        with self.tracer.span(self.name + ".read_block", key=offset):
+            return self.backend.read_block(offset)
+
+    def read_range(self, offset, start, end):
+        with self.tracer.span(self.name + ".read_range", key=offset, start=start, end=end):
+            return self.backend.read_range(offset, start, end)
+
+    def write_block(self, block, offset):
+        with self.tracer.span(self.name + ".write_block", key=offset, size=len(block)):
+            return self.backend.write_block(block, offset)
+
+    def delete_block(self, offset):
+        with self.tracer.span(self.name + ".delete_block", key=offset):
+            return self.backend.delete_block(offset)
+
+    def iter_blocks(self, prefix=None, page_size=1000):
+        return self.backend.iter_blocks(prefix=prefix, page_size=page_size)
+
+    def iter_block_sizes(self, prefix=None, page_size=1000):
+        return self.backend.iter_block_sizes(prefix=prefix, page_size=page_size)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
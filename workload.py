@@ -0,0 +1,209 @@
+import struct
+import threading
+import time
+
+from basic_defs import NAS
+
+#
+# workload traces
+#
+#     file:   magic, then one record per call
+#     record: op (u8), stream (u16), microseconds since the recording started (u64),
+#             fd (i64), offset (u64), length (u64), extra length (u32), extra
+#     extra is the filename for open/delete, and the data of writes if payloads are recorded
+#     read_bytes/write_bytes are ops of their own, so they're replayed with the raw data instead of as text
+#     a stream is one of the recording's client threads, replay gives each stream its own thread
+#
+magic  = b"NASTRACE1\n"
+record = struct.Struct("!BHQqQQI")
+OPEN, READ, WRITE, CLOSE, DELETE, READ_BYTES, WRITE_BYTES = range(1, 8)
+op_names = { OPEN: "open", READ: "read", WRITE: "write", CLOSE: "close", DELETE: "delete", READ_BYTES: "read_bytes", WRITE_BYTES: "write_bytes" }
+
+def _as_bytes(data):
+    return data if isinstance(data, bytes) else data.encode("utf-8")
+
+class Recording_NAS(NAS):
+    """
+    Wraps any NAS and logs every open/read/write/close/delete to a trace file (see the top of this file)
+    """
+    def __init__(self, nas, path, record_payload=False):
+        self.nas            = nas
+        self.record_payload = record_payload
+        self.started        = time.time()
+        self.lock           = threading.Lock()
+        self.streams        = dict() # thread id => stream number
+        self.file           = open(path, "wb")
+        self.file.write(magic)
+
+    def open(self, filename):
+        called = time.time()
+        fd = self.nas.open(filename)
+        self._record(OPEN, called, fd, 0, 0, _as_bytes(filename))
+        return fd
+
+    def read(self, fd, len, offset):
+        self._record(READ, time.time(), fd, offset, len)
+        return self.nas.read(fd, len, offset)
+
+    def write(self, fd, data, offset):
+        payload = _as_bytes(data)
+        self._record(WRITE, time.time(), fd, offset, len(payload), payload if self.record_payload else b"")
+        return self.nas.write(fd, data, offset)
+
+    def read_bytes(self, fd, len, offset):
+        self._record(READ_BYTES, time.time(), fd, offset, len)
+        return self.nas.read_bytes(fd, len, offset)
+
+    def write_bytes(self, fd, data, offset):
+        payload = bytes(data)
+        self._record(WRITE_BYTES, time.time(), fd, offset, len(payload), payload if self.record_payload else b"")
+        return self.nas.write_bytes(fd, data, offset)
+
+    def close(self, fd):
+        self._record(CLOSE, time.time(), fd, 0, 0)
+        return self.nas.close(fd)
+
+    def delete(self, filename):
+        self._record(DELETE, time.time(), 0, 0, 0, _as_bytes(filename))
+        return self.nas.delete(filename)
+
+    def get_storage_sizes(self):
+        return self.nas.get_storage_sizes()
+
+    def stop(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def __getattr__(self, name):
+        # flush, snapshot, hot_tier, etc
+        return getattr(self.nas, name)
+
+    def _record(self, op, called, fd, offset, length, extra=b""):
+        with self.lock:
+            if self.file.closed:
+                return
+            thread_id = threading.current_thread().ident
+            stream = self.streams.get(thread_id, None)
+            if stream is None:
+                stream = self.streams[thread_id] = len(self.streams) & 0xffff
+            self.file.write(record.pack(op, stream, int((called - self.started) * 1e6), fd, offset, length, len(extra)))
+            self.file.write(extra)
+
+
+def read_trace(path):
+    """
+    :yields (op, stream, microseconds, fd, offset, length, extra)
+    """
+    with open(path, "rb") as the_file:
+        if the_file.read(len(magic)) != magic:
+            raise IOError("'%s' isn't a NAS workload trace" % path)
+        while True:
+            header = the_file.read(record.size)
+            if len(header) < record.size:
+                return
+            op, stream, microseconds, fd, offset, length, extra_size = record.unpack(header)
+            extra = the_file.read(extra_size)
+            if len(extra) < extra_size:
+                # cut off mid-record (recording was killed)
+                return
+            yield op, stream, microseconds, fd, offset, length, extra
+
+def replay(nas, path, speed=1.0):
+    """
+    re-runs a trace against nas
+        speed=1.0 keeps the recorded timing, 2.0 is twice as fast, None/0 is as fast as possible
+    :returns { op name: latency stats (see latency_stats) }, plus "elapsed" and "ops_per_second"
+    """
+    streams = dict()
+    for each in read_trace(path):
+        streams.setdefault(each[1], []).append(each)
+    fds = dict() # recorded fd => fd from this nas
+    fds_changed = threading.Condition(threading.Lock())
+    latencies = dict((name, []) for name in op_names.values())
+    errors = []
+    started = time.time()
+
+    def fd_for(recorded_fd):
+        # the open may be on another stream that hasn't gotten to it yet
+        with fds_changed:
+            deadline = time.time() + 10
+            while recorded_fd not in fds:
+                if time.time() > deadline:
+                    raise IOError("The trace uses fd %d before opening it" % recorded_fd)
+                fds_changed.wait(0.1)
+            return fds[recorded_fd]
+
+    def run_stream(calls):
+        try:
+            for op, stream, microseconds, fd, offset, length, extra in calls:
+                if speed:
+                    wait = started + microseconds / 1e6 / speed - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                if op == OPEN:
+                    call_started = time.time()
+                    new_fd = nas.open(extra if str is bytes else extra.decode("utf-8"))
+                    elapsed = time.time() - call_started
+                    with fds_changed:
+                        fds[fd] = new_fd
+                        fds_changed.notify_all()
+                else:
+                    if op == READ:
+                        arguments = (nas.read, fd_for(fd), length, offset)
+                    elif op == WRITE:
+                        # without a recorded payload, any data of the same size will do
+                        data = extra if extra else b"x" * length
+                        arguments = (nas.write, fd_for(fd), data.decode("utf-8", "replace"), offset)
+                    elif op == READ_BYTES:
+                        arguments = (nas.read_bytes, fd_for(fd), length, offset)
+                    elif op == WRITE_BYTES:
+                        arguments = (nas.write_bytes, fd_for(fd), extra if extra else b"x" * length, offset)
+                    elif op == CLOSE:
+                        arguments = (nas.close, fd_for(fd))
+                    else:
+                        arguments = (nas.delete, extra if str is bytes else extra.decode("utf-8"))
+                    call_started = time.time()
+                    arguments[0](*arguments[1:])
+                    elapsed = time.time() - call_started
+                latencies[op_names[op]].append(elapsed)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [ threading.Thread(target=run_stream, args=(calls,)) for _, calls in sorted(streams.items()) ]
+    for each in threads:
+        each.start()
+    for each in threads:
+        each.join()
+    if errors:
+        raise errors[0]
+    elapsed = time.time() - started
+    report = dict((name, latency_stats(values)) for name, values in latencies.items() if values)
+    report["elapsed"] = elapsed
+    report["ops_per_second"] = sum(len(values) for values in latencies.values()) / max(elapsed, 1e-9)
+    return report
+
+def latency_stats(latencies):
+    """
+    :returns count, mean, p50, p90, p99 and max, in milliseconds
+    """
+    ordered = sorted(latencies)
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return dict(
+        count=len(ordered),
+        mean=sum(ordered) / len(ordered) * 1000,
+        p50=percentile(0.50),
+        p90=percentile(0.90),
+        p99=percentile(0.99),
+        max=ordered[-1] * 1000,
+    )
+
+def format_report(report):
+    lines = [ "%-11s %8s %10s %10s %10s %10s %10s" % ("op", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms") ]
+    for name in ("open", "read", "write", "read_bytes", "write_bytes", "close", "delete"):
+        if name in report:
+            stats = report[name]
+            lines.append("%-11s %8d %10.3f %10.3f %10.3f %10.3f %10.3f" % (name, stats["count"], stats["mean"], stats["p50"], stats["p90"], stats["p99"], stats["max"]))
+    lines.append("%.2fs, %.1f ops/s" % (report["elapsed"], report["ops_per_second"]))
+    return "\n".join(lines)